@@ -41,8 +41,17 @@ _SETTINGS_TEMPLATE = """
     ,"autostart": true
     // Sync automatically interval (in seconds)
     ,"sync_interval": 30
-    // Number of notes synchronized each time
+    // Number of notes fetched per page, all pages are synchronized
     ,"sync_note_number": 1000
+    // Only fetch the notes changed since the last sync (falls back to a full sync when needed)
+    ,"incremental_sync": true
+    // Keep note contents on disk and load them when a note is opened
+    ,"lazy_note_content": true
+    // Ordered index of the notes by modification date: "sortedarray" (blocked sorted lists)
+    // or "rbtree" (red-black tree)
+    ,"note_index": "sortedarray"
+    // Size (in bytes) of the local note journal that triggers its compaction into the note store
+    ,"note_journal_limit": 4194304
     // Conflict resolution (If a file was edited on another client and also here, on sync..)
     // Server Wins (Same as selecting 'Overwrite')
     ,"on_conflict_use_server": false
@@ -137,12 +146,14 @@ class _BaseConfig:
     SIMPLENOTE_CACHE_DIR = os.path.join(cache_path(), SIMPLENOTE_PROJECT_NAME)
     os.makedirs(SIMPLENOTE_CACHE_DIR, exist_ok=True)
     SIMPLENOTE_TOKEN_FILE_PATH = os.path.join(SIMPLENOTE_CACHE_DIR, "token.json")
-    SIMPLENOTE_NOTE_CACHE_FILE_PATH = os.path.join(SIMPLENOTE_CACHE_DIR, "note_cache.pkl")
+    SIMPLENOTE_NOTE_STORE_FILE_PATH = os.path.join(SIMPLENOTE_CACHE_DIR, "notes.sqlite3")
     SIMPLENOTE_NOTES_DIR = os.path.join(SIMPLENOTE_CACHE_DIR, "notes")
     os.makedirs(SIMPLENOTE_NOTES_DIR, exist_ok=True)
+    SIMPLENOTE_CONTENTS_DIR = os.path.join(SIMPLENOTE_CACHE_DIR, "contents")
 
     SIMPLENOTE_STARTED_KEY: str = "simplenote_started"
     SIMPLENOTE_SYNC_TIMES_KEY: str = "simplenote_sync_times"
+    SIMPLENOTE_SYNC_CURSOR_KEY: str = "simplenote_sync_cursor"
 
 
 class Development(_BaseConfig):
@@ -4,7 +4,7 @@ import os
 import subprocess
 import sys
 import tempfile
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import sublime
 import sublime_plugin
@@ -13,6 +13,7 @@ from ._config import CONFIG
 from .lib.core import (
     GlobalStorage,
     PreserveSelectionAndView,
+    _show_message,
     close_view,
     on_note_changed,
     open_view,
@@ -20,7 +21,8 @@ from .lib.core import (
     show_quick_panel,
 )
 from .lib.models import Note
-from .lib.operations import NoteCreator, NoteDeleter, NotesIndicator, NoteUpdater, Operator
+from .lib.operations import NoteDeleter, NotesIndicator, NoteUpdater, Operator, OutboxFlusher
+from .lib.simplenote import Local, OutboxAction
 
 
 __all__ = [
@@ -37,6 +39,49 @@ logger = logging.getLogger()
 
 operator = Operator()
 global_storage = GlobalStorage()
+local = Local()
+
+
+def on_note_saved(note: Note):
+    on_note_changed(note)
+    local.save_objects([note])
+
+
+def on_changes_sent(results: List[Tuple[str, OutboxAction, int, int, Union[Optional[Note], Exception]]]):
+    for note_id, action, revision, attempts, result in results:
+        if isinstance(result, Exception):
+            delay = local.change_failed(note_id, revision, attempts)
+            _show_message("Simplenote: upload failed, your changes are kept and retried in %ds" % delay)
+            return
+        if action == OutboxAction.TRASH or result is None:
+            local.change_sent(note_id, revision)
+        elif local.change_sent(note_id, revision, [result]):
+            on_note_changed(result)
+        elif local.store is not None:
+            # Saved again during the upload, the next flush uploads the newer content
+            result.content = local.store.load(note_id)
+    if results and local.due_changes(limit=1):
+        flush_outbox()
+
+
+def flush_outbox():
+    outbox_flusher = OutboxFlusher()
+    outbox_flusher.set_callback(on_changes_sent)
+    operator.add_operation(outbox_flusher)
+
+
+def upload_change(note: Note, action: OutboxAction = OutboxAction.MODIFY):
+    """Queue a local change and upload it, it stays queued across restarts until the server has it"""
+    if local.queue_change(note, action):
+        flush_outbox()
+        return
+    # No note store to queue the change in, upload it once
+    if action == OutboxAction.TRASH:
+        operator.add_operation(NoteDeleter(note=note))
+        return
+    note_updater = NoteUpdater(note=note)
+    note_updater.set_callback(on_note_saved)
+    operator.add_operation(note_updater)
 
 
 # class SimplenoteTextChangeCommand(sublime_plugin.TextChangeListener):
@@ -225,9 +270,7 @@ class SimplenoteViewCommand(sublime_plugin.EventListener):
         if note.d.content == view_content:
             return
         note.content = view_content
-        note_updater = NoteUpdater(note=note)
-        note_updater.set_callback(on_note_changed)
-        operator.add_operation(note_updater)
+        upload_change(note)
 
 
 class SimplenoteListCommand(sublime_plugin.ApplicationCommand):
@@ -248,6 +291,13 @@ class SimplenoteSyncCommand(sublime_plugin.ApplicationCommand):
 
     def callback(self, updated_notes: List[Note]):
         self.merge_note(updated_notes)
+        cursor = global_storage.get(CONFIG.SIMPLENOTE_SYNC_CURSOR_KEY) or ""
+        stored = local.save_objects(updated_notes, cursor=cursor)
+        settings = sublime.load_settings(CONFIG.SIMPLENOTE_SETTINGS_FILE_PATH)
+        if settings.get("lazy_note_content", True):
+            # The contents are on disk now, only keep their titles and previews in memory
+            for note in updated_notes:
+                note.offload(save=not stored)
 
         sync_times = global_storage.get(CONFIG.SIMPLENOTE_SYNC_TIMES_KEY)
         if not isinstance(sync_times, int):
@@ -262,9 +312,12 @@ class SimplenoteSyncCommand(sublime_plugin.ApplicationCommand):
         global_storage.optimistic_update(CONFIG.SIMPLENOTE_SYNC_TIMES_KEY, sync_times + 1)
         global_storage.optimistic_update(CONFIG.SIMPLENOTE_STARTED_KEY, False)
 
+    def exception_callback(self, err: Exception):
+        global_storage.optimistic_update(CONFIG.SIMPLENOTE_STARTED_KEY, False)
+
     def run(self):
-        if operator.running:
-            return
+        if local.due_changes(limit=1):
+            flush_outbox()
         if global_storage.get(CONFIG.SIMPLENOTE_STARTED_KEY):
             return
         global_storage.optimistic_update(CONFIG.SIMPLENOTE_STARTED_KEY, True)
@@ -274,28 +327,26 @@ class SimplenoteSyncCommand(sublime_plugin.ApplicationCommand):
         if not isinstance(sync_note_number, int):
             show_message("`sync_note_number` must be an integer. Please check settings file.")
             return
-        note_indicator = NotesIndicator(sync_note_number=sync_note_number)
+        cursor = ""
+        if settings.get("incremental_sync", True):
+            cursor = global_storage.get(CONFIG.SIMPLENOTE_SYNC_CURSOR_KEY) or ""
+        note_indicator = NotesIndicator(sync_note_number=sync_note_number, cursor=cursor)
         note_indicator.set_callback(self.callback)
+        note_indicator.set_exception_callback(self.exception_callback)
         operator.add_operation(note_indicator)
 
 
 class SimplenoteCreateCommand(sublime_plugin.ApplicationCommand):
 
-    def handle_new_note(self, note: Note):
-        view = open_view(note.filepath)
-
     def run(self):
-        note_creator = NoteCreator()
-        note_creator.set_callback(self.handle_new_note)
-        operator.add_operation(note_creator)
+        # Created locally right away, uploaded by the outbox
+        note = Note()
+        upload_change(note)
+        view = open_view(note.filepath)
 
 
 class SimplenoteDeleteCommand(sublime_plugin.ApplicationCommand):
 
-    def handle_deletion(self, note: Note, view: sublime.View):
-        close_view(view)
-        note.close()
-
     def run(self):
         view: sublime.View | None = sublime.active_window().active_view()
         if not isinstance(view, sublime.View):
@@ -306,6 +357,8 @@ class SimplenoteDeleteCommand(sublime_plugin.ApplicationCommand):
         note = Note.get_note_from_filepath(view_filepath)
         if not isinstance(note, Note):
             return
-        note_deleter = NoteDeleter(note=note)
-        note_deleter.set_callback(self.handle_deletion, {"view": view})
-        operator.add_operation(note_deleter)
+        # Hidden from the note list right away, trashed on the server by the outbox
+        note.d.deleted = True
+        upload_change(note, OutboxAction.TRASH)
+        close_view(view)
+        note.close()
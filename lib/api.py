@@ -7,18 +7,18 @@ import functools
 import json
 import logging
 import time
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Dict, Iterator, Optional
 from urllib.parse import urlencode
 from uuid import uuid4
 
 from .._config import CONFIG
 from ..utils.patterns.singleton.base import Singleton
-from ..utils.request import Response, request
+from ..utils.request import JSONStream, Response, request
 
 
 logger = logging.getLogger()
 
-__all__ = ["Simplenote"]
+__all__ = ["Simplenote", "SimplenoteCursorRejected", "SimplenoteVersionConflict"]
 
 
 class URL:
@@ -79,6 +79,25 @@ class SimplenoteLoginFailed(Exception):
         super().__init__(message)
 
 
+class SimplenoteCursorRejected(Exception):
+    """The server refused the `since` change version, a full index is required"""
+
+    def __init__(self, cursor: str, response: Response):
+        super().__init__("Simplenote index cursor %s rejected: %s" % (cursor, response))
+        self.cursor = cursor
+        self.response = response
+
+
+class SimplenoteVersionConflict(Exception):
+    """The version a change was based on is not accepted by the server"""
+
+    def __init__(self, note_id: str, version: int, response: Response):
+        super().__init__("Simplenote note %s version %s conflict: %s" % (note_id, version, response))
+        self.note_id = note_id
+        self.version = version
+        self.response = response
+
+
 class Simplenote(Singleton):
     """Class for interacting with the simplenote web service"""
 
@@ -167,6 +186,9 @@ class Simplenote(Singleton):
         self,
         limit: int = 1000,
         data: bool = False,
+        since: Optional[str] = None,
+        mark: Optional[str] = None,
+        item: Optional[Callable[[Dict[str, Any]], Any]] = None,
     ):
         """Method to get the note list
 
@@ -177,6 +199,11 @@ class Simplenote(Singleton):
         Arguments:
             - limit (int): number of notes to return
             - data (bool): whether to return the note data or not
+            - since (str): optional change version (the `current` of a previous
+              index), only notes changed after it are returned
+            - mark (str): optional `mark` of a previous page, to continue the list from it
+            - item (callable): optional conversion of every note of the page, applied
+              while the page downloads; the notes it returns None for are left out
             - tags=[] list of tags as string: return notes that have
               at least one of these tags
 
@@ -209,15 +236,52 @@ class Simplenote(Singleton):
         }
         if data:
             params["data"] = "true"
+        if since:
+            params["since"] = since
+        if mark:
+            params["mark"] = mark
 
+        # The notes are parsed one by one as they arrive, the page is never held as text
+        stream = JSONStream("index") if item is None else JSONStream("index", item)
         response = request(
             URL.index(**params),
             method="GET",
-            params=params,
             headers={self.header: self.token},
+            stream=stream,
         )
+        if since and 400 <= response.status < 500 and response.status not in (401, 403):
+            raise SimplenoteCursorRejected(since, response)
         return response.data
 
+    def iter_index(
+        self,
+        limit: int = 1000,
+        data: bool = False,
+        since: Optional[str] = None,
+        item: Optional[Callable[[Dict[str, Any]], Any]] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """Method to walk the whole note list page by page
+
+        Follows the `mark` of every page until the server stops returning one,
+        so accounts with more than `limit` notes are listed completely.
+
+        Arguments:
+            - limit (int): number of notes per page
+            - data (bool): whether to return the note data or not
+            - since (str): optional change version, see `index`
+            - item (callable): optional conversion of every note, see `index`
+
+        Yields:
+            - page (dict): the result of each `index` request
+        """
+        mark = None
+        while True:
+            page = self.index(limit, data, since, mark, item)
+            yield page
+            mark = page.get("mark") if isinstance(page, dict) else None
+            if not mark:
+                return
+
     def retrieve(self, note_id: str, version: Optional[int] = None):
         """Method to get a specific note
 
@@ -239,13 +303,19 @@ class Simplenote(Singleton):
     def modify(self, note: Dict[str, Any], note_id: Optional[str] = None, version: Optional[int] = None):
         """Method to modify or create a note
 
+        Fields missing from `note` are left unchanged by the server, so a partial
+        note only uploads the changed fields.
+
         Arguments:
-            - note (dict): note object
+            - note (dict): note object, or only its changed fields
             - note_id (string): optional ID of the note
-            - version (int): optional version of the note
+            - version (int): optional version of the note the change is based on
 
         Returns:
             - note (dict): note object
+
+        Raises:
+            - SimplenoteVersionConflict: the server refused the change for `version`
         """
         if not isinstance(note, dict):
             raise ValueError("note should be a string or a dict, but got %s" % note)
@@ -261,6 +331,8 @@ class Simplenote(Singleton):
             headers={self.header: self.token},
             data=note,
         )
+        if version is not None and response.status in (409, 412):
+            raise SimplenoteVersionConflict(note_id, version, response)
         return self._parse_response(note_id, response)
 
     def delete(self, note_id: str, version: Optional[int] = None):
@@ -11,7 +11,8 @@ import sublime
 from .._config import CONFIG
 from ..utils.lock.thread import OptimisticLockingDict
 from ..utils.patterns.singleton.base import Singleton
-from .models import Note
+from .models import Note, file_type_matcher
+from .simplenote import Local
 
 
 logger = logging.getLogger()
@@ -35,7 +36,11 @@ __all__ = [
 
 
 class GlobalStorage(Singleton, OptimisticLockingDict):
-    __mapper_key_type = {CONFIG.SIMPLENOTE_SYNC_TIMES_KEY: int, CONFIG.SIMPLENOTE_STARTED_KEY: bool}
+    __mapper_key_type = {
+        CONFIG.SIMPLENOTE_SYNC_TIMES_KEY: int,
+        CONFIG.SIMPLENOTE_STARTED_KEY: bool,
+        CONFIG.SIMPLENOTE_SYNC_CURSOR_KEY: str,
+    }
 
     def optimistic_update(self, key, new_value):
         """Validate the type of the value before it is stored"""
@@ -57,8 +62,19 @@ def sync(sync_interval: int = 30):
 def start():
     global_storage.optimistic_update(CONFIG.SIMPLENOTE_STARTED_KEY, False)
     global_storage.optimistic_update(CONFIG.SIMPLENOTE_SYNC_TIMES_KEY, 0)
+    # Continue from the notes restored by `load_notes`
+    global_storage.optimistic_update(CONFIG.SIMPLENOTE_SYNC_CURSOR_KEY, Local().cursor)
 
     settings = sublime.load_settings(CONFIG.SIMPLENOTE_SETTINGS_FILE_PATH)
+    try:
+        Note.use_index(settings.get("note_index", "sortedarray"))
+    except ValueError as err:
+        show_message("`note_index` %s. Please check settings file." % err)
+    journal_limit = settings.get("note_journal_limit", Local.journal_limit)
+    if isinstance(journal_limit, int):
+        Local.journal_limit = journal_limit
+    else:
+        show_message("`note_journal_limit` must be an integer. Please check settings file.")
     username = settings.get("username")
     password = settings.get("password")
     if username and password:
@@ -180,7 +196,12 @@ def on_select(list__item: List[float], selected_index: int, *args, **kwargs):
 
 def clear_orphaned_filepaths(list__filename: List[str] = []):
     if not list__filename:
-        list__filename = [note.filename for note in Note.mapper_id_note.values()]
+        notes = list(Note.mapper_id_note.values())
+        titles = [note.title for note in notes]
+        list__filename = [
+            Note.get_filename(note.id, title, extension)
+            for note, title, (_, extension) in zip(notes, titles, file_type_matcher.match_all(titles))
+        ]
     for filename in os.listdir(CONFIG.SIMPLENOTE_NOTES_DIR):
         if filename not in list__filename:
             os.remove(os.path.join(CONFIG.SIMPLENOTE_NOTES_DIR, filename))
@@ -221,7 +242,7 @@ def show_quick_panel(first_sync: bool = False):
             note,
             note.title,
             [
-                note.body[:120] + "..." if len(note.body) > 120 else note.body,
+                note.preview,
                 # f"tags: {note.d.tags}",
             ],  # type: ignore
             f"version:{note.v} | update:{datetime.fromtimestamp(note.d.modificationDate).strftime('%Y-%m-%d %H:%M:%S')}",
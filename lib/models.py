@@ -1,19 +1,23 @@
 from __future__ import annotations
 
+from contextlib import contextmanager
+import gc
 import logging
 import os
 import re
 import string
+import sys
+from threading import RLock
 import time
-from typing import Any, ClassVar, Dict, List, Optional, TypedDict
+from typing import Any, ClassVar, Dict, Iterable, Iterator, List, Optional, Pattern, Protocol, Set, Tuple, TypedDict
 from uuid import uuid4
 
 import sublime
 
 from .._config import CONFIG
 from ..utils.decorator import class_property
-from ..utils.tree.redblacktree import rbtree as RedBlackTree
-from .api import Simplenote
+from ..utils.tree.index import SortedIndex, new_index
+from .api import Simplenote, SimplenoteVersionConflict
 
 
 # from typing_extensions import Unpack
@@ -26,28 +30,128 @@ logger = logging.getLogger()
 VALID_CHARS = "-_.() %s%s" % (string.ascii_letters, string.digits)
 
 
+class FileTypeMatcher:
+    """The `title_extension_map` rules, compiled once and recompiled after the settings change"""
+
+    def __init__(self, settings_file: str = CONFIG.SIMPLENOTE_SETTINGS_FILE_PATH):
+        self.settings_file = settings_file
+        self._rules: Optional[List[Tuple[str, Pattern[str], str]]] = None
+
+    def invalidate(self):
+        self._rules = None
+
+    def _compile(self) -> List[Tuple[str, Pattern[str], str]]:
+        settings = sublime.load_settings(self.settings_file)
+        settings.clear_on_change("title_extension_map")
+        settings.add_on_change("title_extension_map", self.invalidate)
+        title_extension_map: Dict[str, Dict[str, str]] = settings.get("title_extension_map")
+        rules: List[Tuple[str, Pattern[str], str]] = []
+        if not title_extension_map is None and isinstance(title_extension_map, dict):
+            for key, item in title_extension_map.items():
+                try:
+                    rules.append((key, re.compile(item["title_regex"], re.UNICODE), item["extension"]))
+                except (re.error, KeyError, TypeError) as err:
+                    logger.warning(("Invalid `title_extension_map` rule", key, item, err))
+        return rules
+
+    @property
+    def rules(self) -> List[Tuple[str, Pattern[str], str]]:
+        rules = self._rules
+        if rules is None:
+            rules = self._rules = self._compile()
+        return rules
+
+    @staticmethod
+    def _match(rules: List[Tuple[str, Pattern[str], str]], title: str) -> Tuple[Optional[str], str]:
+        for file_type, pattern, extension in rules:
+            if pattern.search(title):
+                return file_type, extension
+        return None, ""
+
+    def match(self, title: str) -> Tuple[Optional[str], str]:
+        return self._match(self.rules, title)
+
+    def match_all(self, titles: Iterable[str]) -> List[Tuple[Optional[str], str]]:
+        rules = self.rules
+        return [self._match(rules, title) for title in titles]
+
+
+file_type_matcher = FileTypeMatcher()
+
+
 def get_file_type(title: str):
     # Determine extension based on title
-    file_type, extension = None, ""
-    settings = sublime.load_settings(CONFIG.SIMPLENOTE_SETTINGS_FILE_PATH)
-    title_extension_map: Dict[str, Dict[str, str]] = settings.get("title_extension_map")
-    if not title_extension_map is None and isinstance(title_extension_map, dict):
-        # logger.info(
-        #     "`title_extension_map` must be a list. Please check settings file: %s."
-        #     % CONFIG.SIMPLENOTE_SETTINGS_FILE_PATH
-        # )
-        for key, item in title_extension_map.items():
-            pattern = re.compile(item["title_regex"], re.UNICODE)
-            if re.search(pattern, title):
-                file_type = key
-                extension = item["extension"]
-                break
-    return file_type, extension
+    return file_type_matcher.match(title)
+
+
+class ContentStore(Protocol):
+    """Where `Note.offload` keeps the note contents, implemented by `FileContentStore` and `NoteStore`"""
+
+    def save(self, note_id: str, content: str) -> bool: ...
+
+    def load(self, note_id: str) -> str: ...
+
+    def remove(self, note_id: str) -> None: ...
+
+
+class FileContentStore:
+    """Note contents kept on disk, one file per note id, while they are not needed in memory"""
+
+    def __init__(self, directory: str = CONFIG.SIMPLENOTE_CONTENTS_DIR):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, note_id: str) -> str:
+        return os.path.join(self.directory, note_id)
+
+    def save(self, note_id: str, content: str) -> bool:
+        path = self._path(note_id)
+        try:
+            with open(path + ".tmp", "wb") as f:
+                f.write(content.encode("utf-8"))
+            os.replace(path + ".tmp", path)
+        except OSError as err:
+            logger.exception(err)
+            return False
+        return True
+
+    def load(self, note_id: str) -> str:
+        with open(self._path(note_id), "rb") as f:
+            return f.read().decode("utf-8")
+
+    def remove(self, note_id: str) -> None:
+        try:
+            os.remove(self._path(note_id))
+        except FileNotFoundError:
+            pass
+
+
+# Shared by every note without tags
+_EMPTY_TAGS: Tuple[str, ...] = ()
+
+
+def _intern_tags(tags: Optional[Iterable[str]]) -> Tuple[str, ...]:
+    if not tags:
+        return _EMPTY_TAGS
+    return tuple(sys.intern(tag) if isinstance(tag, str) else tag for tag in tags)
 
 
 class _Note:
     """Data class for a note object"""
 
+    __slots__ = (
+        "_note",
+        "tags",
+        "deleted",
+        "shareURL",
+        "systemTags",
+        "_content",
+        "publishURL",
+        "_modificationDate",
+        "creationDate",
+    )
+
+    # `_content` is None while the content is offloaded to `Note.content_store`
     __serialize_fields = [
         "tags",
         "deleted",
@@ -62,21 +166,21 @@ class _Note:
     def __init__(
         self,
         _note: Optional[Note] = None,
-        tags: Optional[List[str]] = None,
+        tags: Optional[Iterable[str]] = None,
         deleted: bool = False,
         shareURL: str = "",
-        systemTags: Optional[List[str]] = None,
+        systemTags: Optional[Iterable[str]] = None,
         content: str = "",
         publishURL: str = "",
         modificationDate: float = 0,
         creationDate: float = 0,
     ):
         self._note: Optional[Note] = _note
-        self.tags: List[str] = tags or []
+        self.tags: Tuple[str, ...] = _intern_tags(tags)
         self.deleted: bool = deleted
         self.shareURL: str = shareURL
-        self.systemTags: List[str] = systemTags or []
-        self._content: str = content
+        self.systemTags: Tuple[str, ...] = _intern_tags(systemTags)
+        self._content: Optional[str] = content
         setattr(self, "content", self._content)
         self.publishURL: str = publishURL
         self._modificationDate: float = modificationDate or time.time()
@@ -89,51 +193,84 @@ class _Note:
 
     @modificationDate.setter
     def modificationDate(self, value: float) -> None:
-        # TODO:
-        # logger.info(("@modificationDate.setter", value))
-        # note = getattr(self, "_note", None)
-        # if not isinstance(note, Note):
-        #     raise Exception("modificationDate can only be set on Note objects, not %s" % type(note))
-        # Note.tree.insert(value, note)
         self._modificationDate = value
+        # `Note.__init__` indexes a new `_Note` itself once it is assigned to `d`
+        note = self._note
+        if note is not None and getattr(note, "d", None) is self:
+            note._rekey()
+
+    @classmethod
+    def fields(cls) -> List[str]:
+        return cls.__serialize_fields
 
     @property
     def content(self) -> str:
+        if self._content is None:
+            return "" if self._note is None else self._note._load_content()
         return self._content
 
     @content.setter
     def content(self, value: str) -> None:
         self._content = value
         file_type, extension = get_file_type(value)
-        if file_type and file_type == "markdown":
-            self.systemTags.append("markdown")
+        if file_type and file_type == "markdown" and "markdown" not in self.systemTags:
+            self.systemTags = self.systemTags + ("markdown",)
 
     def _nest_dict(self) -> Dict[str, Any]:
         return {filed: getattr(self, filed) for filed in self.__serialize_fields}
 
 
 class NoteType(TypedDict):
-    tags: List[str]
+    tags: Tuple[str, ...]
     deleted: bool
     shareURL: str
-    systemTags: List[str]
+    systemTags: Tuple[str, ...]
     content: str
     publishURL: str
     modificationDate: float
     creationDate: float
 
 
+# Guards the class-level indexes of `Note` (`mapper_id_note`, `tree`, `mapper_filename_note`),
+# which operations running on several threads update
+_index_lock = RLock()
+
+
 class Note:
+    __slots__ = (
+        "id",
+        "v",
+        "d",
+        "_content",
+        "_synced",
+        "_derived_cache",
+        "_indexed_filename",
+        "_summary",
+        "_tree_key",
+    )
+
     mapper_id_note: ClassVar[Dict[str, "Note"]] = dict()
     # TODO: use weakref
     # mapper_id_note: ClassVar[WeakValueDictionary[str, "Note"]] = WeakValueDictionary()
-    tree: ClassVar[RedBlackTree] = RedBlackTree()
+    # `tree_key` -> note, ordered by modification date, see `use_index`
+    tree: ClassVar[SortedIndex] = new_index("sortedarray")
+    # Set by `rebuilding_tree`, the notes are not moved in `tree` one by one meanwhile
+    _tree_frozen: ClassVar[bool] = False
+    # The filename of the note as written to disk (`_filename`) -> note
+    mapper_filename_note: ClassVar[Dict[str, "Note"]] = dict()
+    content_store: ClassVar[ContentStore] = FileContentStore()
+    # Ids of the notes with a local change waiting to be uploaded, index pages do not overwrite them
+    pending_ids: ClassVar[Set[str]] = set()
 
     def __new__(cls, id: str = "", **kwargs):
         if id not in Note.mapper_id_note:
             instance = super().__new__(cls)
             # TODO:
-            instance.__dict__["_content"] = kwargs.get("d", {}).get("content", "")
+            instance._content = kwargs.get("d", {}).get("content", "")
+            # [content, title, body, filename, rules] of `_content` and `d.content`, see `_derive`
+            instance._derived_cache = ()
+            # (title, preview) of the content while it is offloaded, see `offload`
+            instance._summary = None
 
             return instance
         instance = Note.mapper_id_note[id]
@@ -144,18 +281,134 @@ class Note:
             logger.warning(("Note id %s is not a valid UUID", id, type(id), len(id)))
             id = str(uuid4())
         self.id: str = id
-        Note.mapper_id_note[self.id] = self
-        # Note.tree.remove(self.d.modificationDate)
-        self.v: int = v
-        _d = getattr(self, "d", None)
-        if isinstance(_d, _Note):
-            old_modificationDate = _d.modificationDate
-            Note.tree.remove(old_modificationDate)
-        d["_note"] = self
-        self.d: _Note = _Note(**d)
-        Note.tree.insert(self.d.modificationDate, self)
+        with _index_lock:
+            Note.mapper_id_note[self.id] = self
+            # Note.tree.remove(self.d.modificationDate)
+            self.v: int = v
+            d["_note"] = self
+            self.d: _Note = _Note(**d)
+            # The field values as last acknowledged by the server, the base of delta uploads
+            self._synced: Tuple[Any, ...] = tuple(self.d._nest_dict().values()) if v else ()
+            self._rekey()
         # TODO:
-        self._content = self.__dict__.get("_content", "")
+        self._content = getattr(self, "_content", "")
+        if self._content is None:
+            # The flushed content was offloaded, compare the new content against it
+            try:
+                self._content = self.content_store.load(self.id)
+            except (OSError, LookupError) as err:
+                logger.warning(err)
+                self._content = ""
+        self._trim_derived()
+        self._index_filename()
+
+    @property
+    def tree_key(self) -> Tuple[float, str]:
+        """The key of the note in `tree`, notes modified at the same time are ordered by id"""
+        return (self.d.modificationDate, self.id)
+
+    def _rekey(self):
+        """Move the note to its current `tree_key` in `tree`"""
+        with _index_lock:
+            if Note._tree_frozen:
+                return
+            tree_key = self.tree_key
+            indexed_key = getattr(self, "_tree_key", None)
+            if indexed_key == tree_key:
+                return
+            if indexed_key is not None:
+                # The key contains the id, so it can only belong to this note
+                Note.tree.remove(indexed_key)
+            Note.tree.insert(tree_key, self)
+            self._tree_key = tree_key
+
+    @classmethod
+    def from_summary(cls, id: str, v: int, d: Dict[str, Any], summary: Tuple[str, str]) -> "Note":
+        """A note restored from `content_store` with all its fields but the content,
+        which is loaded on first use like after `offload`"""
+        note = Note(id=id, v=v, d=dict(d, content=""))
+        note._summary = summary
+        note._content = note.d._content = None
+        note._synced = tuple(None if key == "content" else value for key, value in zip(_Note.fields(), note._synced))
+        note._trim_derived()
+        note._index_filename()
+        return note
+
+    @classmethod
+    def rebuild_tree(cls):
+        """Rebuild `tree` from all the known notes in one pass"""
+        # Only new objects and no garbage are created, the cyclic collector would
+        # otherwise walk all the notes many times over
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with _index_lock:
+                # The keys are unique, so the notes themselves are never compared
+                notes = sorted((note.tree_key, note) for note in list(Note.mapper_id_note.values()))
+                Note.tree.load_sorted(notes)
+                for tree_key, note in notes:
+                    note._tree_key = tree_key
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    @classmethod
+    def iter_modified(
+        cls, since: Optional[float] = None, until: Optional[float] = None, reverse: bool = False
+    ) -> Iterator["Note"]:
+        """The notes modified in [since, until), oldest first or newest first with `reverse`.
+
+        e.g. the notes of the last week: `Note.iter_modified(since=time.time() - 7 * 86400)`
+        """
+        # "" sorts before every id, so the bounds fall right before the notes of that date
+        lo = None if since is None else (since, "")
+        hi = None if until is None else (until, "")
+        for _, note in Note.tree.range(lo, hi, reverse=reverse):
+            yield note
+
+    @classmethod
+    def use_index(cls, name: str):
+        """Move the notes to an index of the type named in the `note_index` setting"""
+        index = new_index(name)
+        if type(index) is type(Note.tree):
+            return
+        with cls.rebuilding_tree(), _index_lock:
+            Note.tree = index
+
+    @classmethod
+    @contextmanager
+    def rebuilding_tree(cls):
+        """Skip the per-note `tree` updates inside the block and rebuild `tree` once at the end,
+        for blocks that (re)create most of the notes such as a full index"""
+        with _index_lock:
+            Note._tree_frozen = True
+        try:
+            yield
+        finally:
+            # Notes re-keyed by other threads meanwhile are either in the rebuilt `tree` or
+            # inserted after it
+            with _index_lock:
+                try:
+                    cls.rebuild_tree()
+                finally:
+                    Note._tree_frozen = False
+
+    def _index_filename(self):
+        """Keep `mapper_filename_note` in step with the title the note was flushed with"""
+        filename = self._filename
+        with _index_lock:
+            if filename == getattr(self, "_indexed_filename", None):
+                return
+            self._unindex_filename()
+            Note.mapper_filename_note[filename] = self
+            self._indexed_filename = filename
+
+    def _unindex_filename(self):
+        with _index_lock:
+            indexed_filename = getattr(self, "_indexed_filename", None)
+            if indexed_filename is not None and Note.mapper_filename_note.get(indexed_filename) is self:
+                del Note.mapper_filename_note[indexed_filename]
+            self._indexed_filename = None
 
     # TODO:
     # def __setattr__(self, name: str, value: Any) -> None:
@@ -187,13 +440,36 @@ class Note:
         return Simplenote(username, password)
 
     @classmethod
-    def index(cls, limit: int = 1000, data: bool = True) -> List["Note"]:
-        result = cls.API.index(limit, data)
-        assert isinstance(result, dict)
-        assert "index" in result
-        _notes = result.get("index", [])
-        assert isinstance(_notes, list)
-        return [Note(**note) for note in _notes]
+    def iter_index(
+        cls, limit: int = 1000, data: bool = True, since: Optional[str] = None
+    ) -> Iterator[Tuple[List["Note"], str]]:
+        """Yields the notes of every index page with the `current` change version of the page"""
+        for result in cls.API.iter_index(limit, data, since, item=cls._from_index):
+            assert isinstance(result, dict)
+            assert "index" in result
+            _notes = result.get("index", [])
+            assert isinstance(_notes, list)
+            current = result.get("current", "")
+            assert isinstance(current, str)
+            yield _notes, current
+
+    @classmethod
+    def _from_index(cls, note: Dict[str, Any]) -> Optional["Note"]:
+        """The note of an index entry, created as soon as the entry is downloaded"""
+        if note.get("id") in cls.pending_ids:
+            return None
+        return Note(**note)
+
+    @classmethod
+    def index(cls, limit: int = 1000, data: bool = True, since: Optional[str] = None) -> Tuple[List["Note"], str]:
+        """Returns the indexed notes and the `current` change version of the index"""
+        notes: List[Note] = []
+        cursor = ""
+        for page, current in cls.iter_index(limit, data, since):
+            notes.extend(page)
+            # Changes made while walking the pages are picked up from the first page's version
+            cursor = cursor or current
+        return notes, cursor
 
     @classmethod
     def retrieve(cls, note_id: str) -> "Note":
@@ -207,8 +483,28 @@ class Note:
         assert self.id == _note["id"]
         return self
 
+    def changes(self) -> Dict[str, Any]:
+        """The fields changed since the note was last synced, all of them for an unsynced note"""
+        fields = self.d._nest_dict()
+        if not self._synced:
+            return fields
+        return {
+            key: value
+            for (key, value), synced in zip(fields.items(), self._synced)
+            if key != "modificationDate" and synced != value
+        }
+
     def modify(self, version: Optional[int] = None) -> "Note":
-        _note = self.API.modify(self.d._nest_dict(), self.id, version)
+        if version is None and self._synced:
+            # Upload only the changed fields on top of the synced version,
+            # the full note is sent again if the server refuses that version
+            try:
+                _note = self.API.modify(self.changes(), self.id, self.v)
+            except SimplenoteVersionConflict as err:
+                logger.warning(err)
+                _note = self.API.modify(self.d._nest_dict(), self.id)
+        else:
+            _note = self.API.modify(self.d._nest_dict(), self.id, version)
         assert isinstance(_note, dict)
         self = Note(**_note)
         return self
@@ -217,10 +513,18 @@ class Note:
     def _trash(cls, note_id: str) -> Dict[str, Any]:
         _note = cls.API.trash(note_id)
         assert isinstance(_note, dict)
-        if note_id in Note.mapper_id_note:
-            del Note.mapper_id_note[note_id]
+        cls._forget(note_id)
         return _note
 
+    @classmethod
+    def _forget(cls, note_id: str):
+        """Drop a note locally, without telling the server"""
+        with _index_lock:
+            note = Note.mapper_id_note.pop(note_id, None)
+            if note is not None:
+                note._unindex_filename()
+        cls.content_store.remove(note_id)
+
     def trash(self) -> Dict[str, Any]:
         assert not self.id is None, "Note id is None"
         return self._trash(self.id)
@@ -240,18 +544,89 @@ class Note:
 
     @property
     def need_flush(self) -> bool:
-        return self._content != self.d.content
+        # Offloaded contents (None) are the same content, compare without loading them
+        return self._content is not self.d._content and self._content != self.d._content
 
     def flush(self):
-        self._content = self.d.content
+        self._content = self.d._content
+        self._trim_derived()
+        self._index_filename()
+
+    def offload(self, save: bool = True) -> bool:
+        """Move the content to `content_store`, keeping only its title and preview in memory.
+
+        Only a flushed note is offloaded, the content is loaded back on first use.
+        `save=False` when the store already holds the content.
+        """
+        content = self.d._content
+        if content is None or self.need_flush:
+            return False
+        if save and not self.content_store.save(self.id, content):
+            return False
+        self._summary = (self.get_title(content), self.get_preview(content))
+        self._content = self.d._content = None
+        self._synced = tuple(None if value is content else value for value in self._synced)
+        self._trim_derived()
+        return True
+
+    def _load_content(self) -> str:
+        """Read the offloaded content back from `content_store`"""
+        content = self.content_store.load(self.id)
+        if self._content is None:
+            self._content = content
+        if self.d._content is None:
+            self.d._content = content
+        self._synced = tuple(
+            content if key == "content" and value is None else value for key, value in zip(_Note.fields(), self._synced)
+        )
+        return content
 
     @property
     def content(self) -> str:
+        if self._content is None:
+            return self._load_content()
         return self._content
 
     @content.setter
     def content(self, value: str):
         self.d.content = value
+        self._trim_derived()
+
+    def _derive(self, content: Optional[str]) -> List[Any]:
+        """The [content, title, body, filename, rules] of a content, memoised per content object.
+
+        The body and filename are derived on first use, the filename again after the
+        `title_extension_map` rules change.
+        """
+        if content is None and self._summary is None:
+            content = self.content
+        # An offloaded content is represented by its summary
+        key = content if content is not None else self._summary
+        for derived in self._derived_cache:
+            if derived[0] is key:
+                return derived
+        title = self.get_title(content) if content is not None else self._summary[0]
+        derived = [key, title, None, None, None]
+        self._derived_cache = (derived,) + self._derived_cache[:1]
+        return derived
+
+    def _derive_filename(self, content: Optional[str]) -> str:
+        derived = self._derive(content)
+        rules = file_type_matcher.rules
+        if derived[3] is None or derived[4] is not rules:
+            _, extension = file_type_matcher.match(derived[1])
+            derived[3], derived[4] = self.get_filename(self.id, derived[1], extension), rules
+        return derived[3]
+
+    def _trim_derived(self):
+        """Drop the memoised values of contents the note no longer holds"""
+        _content, content = self._content, self.d._content
+        summary = self._summary if _content is None or content is None else None
+        self._derived_cache = tuple(
+            derived
+            for derived in self._derived_cache
+            if derived[0] is _content or derived[0] is content or (summary is not None and derived[0] is summary)
+        )
 
     @property
     def _title(self):
@@ -259,22 +634,50 @@ class Note:
             content = self._content
         except Exception:
             return CONFIG.SIMPLENOTE_DEFAULT_NOTE_TITLE
-        title, _ = self.get_title_body(content)
-        return title
+        return self._derive(content)[1]
 
     @property
     def title(self):
         try:
-            content = self.d.content
+            content = self.d._content
         except Exception:
             return CONFIG.SIMPLENOTE_DEFAULT_NOTE_TITLE
-        title, _ = self.get_title_body(content)
-        return title
+        return self._derive(content)[1]
 
     @property
     def body(self) -> str:
-        _, body = self.get_title_body(self.d.content)
-        return body
+        content = self.d.content
+        derived = self._derive(content)
+        if derived[2] is None:
+            # The body is nearly a copy of the content, only keep it once it is asked for
+            _, derived[2] = self.get_title_body(content)
+        return derived[2]
+
+    @property
+    def preview(self) -> str:
+        """The beginning of the body as shown in the note list"""
+        if self.d._content is None and self._summary is not None:
+            return self._summary[1]
+        return self.get_preview(self.d.content)
+
+    @staticmethod
+    def get_preview(content: str, length: int = 120) -> str:
+        """`body[:length] + "..."` of `get_title_body`, without copying the body"""
+        if not isinstance(content, str):
+            return "empty body"
+        end = content.find("\n")
+        if end == -1:
+            return "empty body"
+        preview = content[end + 1 : end + 2 + length] or "empty body"
+        return preview[:length] + "..." if len(preview) > length else preview
+
+    @staticmethod
+    def get_title(content: str) -> str:
+        """The title of `get_title_body`, without copying the body"""
+        if not isinstance(content, str):
+            return CONFIG.SIMPLENOTE_DEFAULT_NOTE_TITLE
+        end = content.find("\n")
+        return (content if end == -1 else content[:end]) or CONFIG.SIMPLENOTE_DEFAULT_NOTE_TITLE
 
     @staticmethod
     def get_title_body(content: str) -> tuple[str, str]:
@@ -291,13 +694,11 @@ class Note:
 
     @property
     def _filename(self) -> str:
-        file_type, extension = get_file_type(self._title)
-        return self.get_filename(self.id, self._title, extension)
+        return self._derive_filename(self._content)
 
     @property
     def filename(self) -> str:
-        file_type, extension = get_file_type(self.title)
-        return self.get_filename(self.id, self.title, extension)
+        return self._derive_filename(self.d._content)
 
     @staticmethod
     def get_filename(id: str, title: str, extension: str) -> str:
@@ -357,11 +758,11 @@ class Note:
         view_note_dir, view_note_filename = os.path.split(view_absolute_filepath)
         if view_note_dir != CONFIG.SIMPLENOTE_NOTES_DIR:
             return
-        pattern = re.compile(r"\((.*?)\)")
-        for note in Note.mapper_id_note.values():
-            if note.filename == view_note_filename:
-                return note
+        note = Note.mapper_filename_note.get(view_note_filename)
+        if note is not None:
+            return note
 
+        pattern = re.compile(r"\((.*?)\)")
         # TODO: maybe results include more than one
         results = re.findall(pattern, view_note_filename)
         if results:
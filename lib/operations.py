@@ -1,21 +1,33 @@
-from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from enum import IntEnum
+from functools import partial
+import itertools
 import logging
-from threading import Event, Lock, Semaphore, Thread
-from typing import Any, Callable, Dict, List, Optional
+from threading import Event, Lock, Thread
+import time
+from typing import Any, Callable, ClassVar, Dict, List, Optional, Tuple, Union
 
 import sublime
 
+from .._config import CONFIG
 from ..utils.patterns.singleton.base import Singleton
-from .core import _show_message, edit_settings, remove_status
+from ..utils.request import DeadlineExceeded, deadline, remaining_time
+from .api import SimplenoteCursorRejected
+from .core import _show_message, edit_settings, global_storage, remove_status
 from .models import Note
+from .simplenote import Local, OutboxAction
 
 
 __all__ = [
+    "OperationPriority",
+    "OperationCancelled",
+    "OperationTimedOut",
     "Operation",
     "NotesIndicator",
     "NoteCreator",
     "NoteUpdater",
     "NoteDeleter",
+    "OutboxFlusher",
     "MultipleNoteDownloader",
     "Operator",
 ]
@@ -23,7 +35,32 @@ __all__ = [
 logger = logging.getLogger()
 
 
+class OperationPriority(IntEnum):
+    """Lower values are started first"""
+
+    SAVE = 0
+    MODIFY = 1
+    SYNC = 2
+
+
+class OperationCancelled(Exception):
+    def __init__(self, operation: "Operation", reason: str = "cancelled"):
+        super().__init__("%s %s" % (operation.__class__.__name__, reason))
+
+
+class OperationTimedOut(OperationCancelled):
+    def __init__(self, operation: "Operation"):
+        super().__init__(operation, "timed out after %ss" % operation.deadline)
+
+
 class Operation(Thread):
+    priority: ClassVar[OperationPriority] = OperationPriority.MODIFY
+    # A newly added operation cancels the pending operations of the same class and key
+    supersedes: ClassVar[bool] = False
+    # Seconds the operation may run once started, None means no limit. Its requests
+    # end by then, and `Operator` cancels it when the time is up
+    deadline: ClassVar[Optional[float]] = 60
+
     callback: Optional[Callable[..., Any]]
     callback_kwargs: Dict[str, Any]
     exception_callback: Optional[Callable[..., Any]]
@@ -33,6 +70,28 @@ class Operation(Thread):
         self.callback = None
         self.exception_callback = None
         self.result = None
+        self._cancelled = Event()
+        self._done_callback: Optional[Callable[["Operation"], Any]] = None
+        self.started_at: Optional[float] = None
+
+    @property
+    def key(self) -> Optional[str]:
+        """Operations sharing a key never run at the same time, None means no restriction"""
+        return None
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    @property
+    def expired(self) -> bool:
+        if self.deadline is None or self.started_at is None:
+            return False
+        return time.monotonic() - self.started_at >= self.deadline
+
+    def cancel(self):
+        """Ask the operation to stop, `execute` checks `cancelled` where it can stop early"""
+        self._cancelled.set()
 
     def set_callback(self, callback: Callable[..., Any], kwargs: Optional[Dict[str, Any]] = None):
         self.callback = callback
@@ -43,8 +102,40 @@ class Operation(Thread):
     def set_exception_callback(self, callback: Optional[Callable]):
         self.exception_callback = callback
 
+    def set_done_callback(self, callback: Callable[["Operation"], Any]):
+        """Called from the operation thread as soon as `execute` returns"""
+        self._done_callback = callback
+
+    def execute(self) -> Any:
+        raise NotImplementedError
+
+    def run(self):
+        self.started_at = time.monotonic()
+        try:
+            if self.cancelled:
+                raise OperationCancelled(self)
+            with deadline(self.deadline):
+                self.result = self.execute()
+        except DeadlineExceeded:
+            self.result = OperationTimedOut(self)
+        except Exception as err:
+            # Whatever a request cut short by the deadline made the operation raise
+            self.result = OperationTimedOut(self) if self.expired else err
+        finally:
+            if self._done_callback is not None:
+                self._done_callback(self)
+
     def join(self):
         Thread.join(self)
+        if isinstance(self.result, OperationCancelled):
+            if isinstance(self.result, OperationTimedOut):
+                logger.warning(str(self.result))
+                _show_message("Simplenote: %s" % self.result)
+            else:
+                logger.info(str(self.result))
+            if self.exception_callback:
+                self.exception_callback(self.result)
+            return
         if not self.callback is None:
             if not isinstance(self.result, Exception):
                 self.callback(self.result, **self.callback_kwargs)
@@ -59,43 +150,79 @@ class Operation(Thread):
 
 
 class NotesIndicator(Operation):
+    priority = OperationPriority.SYNC
+    supersedes = True
+    # Every page of a large account is fetched
+    deadline = 300
 
-    def __init__(self, *args, sync_note_number: int = 1000, **kwargs):
+    def __init__(self, *args, sync_note_number: int = 1000, cursor: str = "", **kwargs):
         super().__init__(*args, **kwargs)
         self.sync_note_number = sync_note_number
+        # The `current` change version of the last sync, empty for a full index
+        self.cursor = cursor
 
-    def run(self):
-        try:
-            result: List[Note] = Note.index(limit=self.sync_note_number, data=True)
-            self.result = result
-        except Exception as err:
-            self.result = err
+    @property
+    def key(self) -> Optional[str]:
+        return "index"
+
+    def _index(self, since: Optional[str] = None) -> Tuple[List[Note], str]:
+        result: List[Note] = []
+        cursor = ""
+        for page, current in Note.iter_index(limit=self.sync_note_number, data=True, since=since):
+            result.extend(page)
+            cursor = cursor or current
+            if self.cancelled:
+                raise OperationCancelled(self)
+        return result, cursor
+
+    def _full_index(self) -> Tuple[List[Note], str]:
+        if Note.tree.count:
+            # Known notes keep their place in `Note.tree` unless they changed
+            return self._index()
+        # The first sync creates every note, `Note.tree` is bulk loaded once at the end
+        with Note.rebuilding_tree():
+            return self._index()
+
+    def execute(self):
+        if self.cursor:
+            try:
+                result, current = self._index(since=self.cursor)
+            except SimplenoteCursorRejected as err:
+                logger.warning(err)
+                result, current = self._full_index()
+        else:
+            result, current = self._full_index()
+        global_storage.optimistic_update(CONFIG.SIMPLENOTE_SYNC_CURSOR_KEY, current)
+        self.cursor = current
+        return result
 
 
 class NoteCreator(Operation):
 
-    def run(self):
-        try:
-            note = Note()
-            note.create()
-            self.result = note
-        except Exception as err:
-            self.result = err
+    def execute(self):
+        note = Note()
+        note.create()
+        return note
 
 
 class NoteUpdater(Operation):
+    priority = OperationPriority.SAVE
+    # The note content is read when the update runs, so only the last pending
+    # update of a note needs to be uploaded
+    supersedes = True
 
     def __init__(self, *args, note: Optional[Note] = None, **kwargs):
         super().__init__(*args, **kwargs)
         assert isinstance(note, Note)
         self.note: Note = note
 
-    def run(self):
-        try:
-            note: Note = self.note.modify()
-            self.result = note
-        except Exception as err:
-            self.result = err
+    @property
+    def key(self) -> Optional[str]:
+        return self.note.id
+
+    def execute(self):
+        note: Note = self.note.modify()
+        return note
 
 
 class NoteDeleter(Operation):
@@ -104,112 +231,216 @@ class NoteDeleter(Operation):
         super().__init__(*args, **kwargs)
         self.note: Note = note
 
-    def run(self):
-        try:
-            self.note.trash()
-            self.result = self.note
-        except Exception as err:
-            self.result = err
+    @property
+    def key(self) -> Optional[str]:
+        return self.note.id
 
+    def execute(self):
+        self.note.trash()
+        return self.note
 
-class MultipleNoteDownloader(Operation):
 
-    def __init__(self, notes: List[Note], *args, semaphore: int = 9, **kwargs):
+class OutboxFlusher(Operation):
+    """Uploads the local changes queued by `Local.queue_change`, oldest first.
+
+    The result lists `(note id, action, revision, attempts, note or exception)`
+    of the uploaded changes; the flush stops at the first failure, so with the
+    network down a flush costs one request and the rest wait for the next one.
+    """
+
+    priority = OperationPriority.SAVE
+    # The changes are read from the outbox when the flush runs
+    supersedes = True
+
+    def __init__(self, *args, batch_size: int = 100, **kwargs):
         super().__init__(*args, **kwargs)
-        self.semaphore = semaphore
-        self.notes: List[Note] = notes
+        self.batch_size = batch_size
 
-    def run(self):
-        sem = Semaphore(self.semaphore)
-        done_event = Event()
-
-        def note_retriever(note_id: str, results: List[Note]):
-            with sem:
-                note = Note.retrieve(note_id)
-                results.append(note)
-                done_event.set()
-
-        threads: List[Thread] = []
-        results: List[Note] = []
-        for note in self.notes:
-            assert isinstance(note, Note)
-            assert isinstance(note.id, str)
-            new_thread = Thread(
-                target=note_retriever,
-                args=(
-                    note.id,
-                    results,
-                ),
-            )
-            threads.append(new_thread)
-            new_thread.start()
-
-        _ = [th.join() for th in threads]
+    @property
+    def key(self) -> Optional[str]:
+        return "outbox"
+
+    @staticmethod
+    def _upload(note: Optional[Note], action: OutboxAction) -> Optional[Note]:
+        if note is None:
+            # Dropped locally since it was queued, nothing left to upload
+            return None
+        if action == OutboxAction.TRASH:
+            if note.v:
+                note.trash()
+            else:
+                # Never uploaded, the server does not know the note
+                Note._forget(note.id)
+            return note
+        return note.modify()
+
+    def execute(self):
+        results: List[Tuple[str, OutboxAction, int, int, Union[Optional[Note], Exception]]] = []
+        for note_id, action, revision, attempts in Local().due_changes(limit=self.batch_size):
+            if self.cancelled:
+                break
+            try:
+                result = self._upload(Note.mapper_id_note.get(note_id), action)
+            except Exception as err:
+                logger.warning(err)
+                results.append((note_id, action, revision, attempts, err))
+                break
+            results.append((note_id, action, revision, attempts, result))
+        return results
 
+
+class MultipleNoteDownloader(Operation):
+    priority = OperationPriority.SYNC
+    deadline = 300
+
+    def __init__(self, notes: List[Note], *args, max_workers: int = 9, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_workers = max_workers
+        self.notes: List[Note] = notes
+        # note id -> retrieved note, or the exception raised while retrieving it
+        self.results: Dict[str, Union[Note, Exception]] = {}
+        self.progress: Tuple[int, int] = (0, len(notes))
+
+    def on_progress(self, done: int, total: int):
+        self.progress = (done, total)
+        text = "Simplenote: %s %s/%s" % (self.__class__.__name__, done, total)
+        sublime.set_timeout(partial(_show_message, text), 0)
+
+    @staticmethod
+    def _retrieve(note_id: str, ends_at: Optional[float]) -> Note:
+        with deadline(None if ends_at is None else ends_at - time.monotonic()):
+            return Note.retrieve(note_id)
+
+    def execute(self):
+        total = len(self.notes)
+        # The deadline is per thread, the workers keep to the one of this operation
+        left = remaining_time()
+        ends_at = None if left is None else time.monotonic() + left
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="note_retriever") as executor:
+            future__note_id: Dict[Future, str] = {}
+            for note in self.notes:
+                assert isinstance(note, Note)
+                assert isinstance(note.id, str)
+                future__note_id[executor.submit(self._retrieve, note.id, ends_at)] = note.id
+
+            for done, future in enumerate(as_completed(future__note_id), 1):
+                note_id = future__note_id[future]
+                try:
+                    self.results[note_id] = future.result()
+                except Exception as err:
+                    logger.exception(err)
+                    self.results[note_id] = err
+                self.on_progress(done, total)
+                if self.cancelled:
+                    for pending in future__note_id:
+                        pending.cancel()
+                    raise OperationCancelled(self)
+
+        results = [self.results[note.id] for note in self.notes]
         for result in results:
             if isinstance(result, Exception):
-                self.result = result
-                return
-        self.result = results
+                raise result
+        return results
 
 
 class Operator(Singleton):
-    __lock = Lock()
-
-    # def __new__(cls, *args, **kwargs):
-    #     with cls.__lock:
-    #         if not cls.__instance:
-    #             cls.__instance = super().__new__(cls, *args, **kwargs)
-    #     # logger.debug((Thread.ident, cls.__instance))
-    #     return cls.__instance
-
-    def __init__(self):
-        self.operations: deque[Operation] = deque([])
-        self._running = False
-        self.current_operation = None
+    """Schedules operations by priority on at most `max_workers` threads.
+
+    Pending operations are started in (priority, insertion) order, skipping those
+    whose key is held by a running operation. Completion is signalled by the
+    operation thread itself and handled on the main thread right away, where the
+    operation callbacks are delivered and the next operations are started.
+    """
+
+    def __init__(self, max_workers: int = 3):
+        self.max_workers = max_workers
+        self.__lock = Lock()
+        self.__sequence = itertools.count()
+        # (priority, sequence, operation), kept sorted
+        self.operations: List[Tuple[int, int, Operation]] = []
+        self.running_operations: List[Operation] = []
+        # operation class name -> number of pending operations dropped in favour of a newer one,
+        # the uploads saved by the outbox are counted in `Local.superseded_changes`
+        self.superseded: Dict[str, int] = {}
 
     @property
-    def running(self):
-        return self._running
-
-    @running.setter
-    def running(self, value: bool):
-        assert isinstance(value, bool), "Invalid value for running, expected bool got %s" % type(value)
-        self._running = value
+    def running(self) -> bool:
+        return bool(self.operations or self.running_operations)
 
     def add_operation(self, operation: Operation):
-        self.operations.append(operation)
+        with self.__lock:
+            if operation.supersedes:
+                self._cancel_pending(type(operation), operation.key)
+            self.operations.append((operation.priority, next(self.__sequence), operation))
+            self.operations.sort(key=lambda item: item[:2])
+        self.schedule()
+
+    def _cancel_pending(self, operation_type: type, key: Optional[str]):
+        """Drop the pending operations superseded by a new one, the caller holds the lock"""
+        pending = []
+        for item in self.operations:
+            operation = item[2]
+            if type(operation) is operation_type and operation.key == key:
+                operation.cancel()
+                name = operation_type.__name__
+                self.superseded[name] = self.superseded.get(name, 0) + 1
+                logger.info("Superseded pending %s, %s so far" % (name, self.superseded[name]))
+                continue
+            pending.append(item)
+        self.operations = pending
+
+    def cancel(self, key: Optional[str] = None):
+        """Cancel the pending and running operations with the key, or all of them"""
+        with self.__lock:
+            for operation in [item[2] for item in self.operations] + self.running_operations:
+                if key is None or operation.key == key:
+                    operation.cancel()
+            self.operations = [item for item in self.operations if not item[2].cancelled]
+
+    def schedule(self):
+        started: List[Operation] = []
+        with self.__lock:
+            busy_keys = {operation.key for operation in self.running_operations if operation.key is not None}
+            pending = []
+            for item in self.operations:
+                operation = item[2]
+                if len(self.running_operations) >= self.max_workers or operation.key in busy_keys:
+                    pending.append(item)
+                    continue
+                if operation.key is not None:
+                    busy_keys.add(operation.key)
+                self.running_operations.append(operation)
+                started.append(operation)
+            self.operations = pending
+
+        for operation in started:
+            logger.info(operation.__class__.__name__)
+            operation.set_done_callback(self._on_operation_done)
+            operation.start()
+            if operation.deadline is not None:
+                sublime.set_timeout(partial(self._expire, operation), int(operation.deadline * 1000))
+            _show_message("Simplenote: %s staring" % operation.__class__.__name__)
+
+    @staticmethod
+    def _expire(operation: Operation):
+        # Its requests already end at the deadline, this stops it between them
+        if operation.is_alive():
+            logger.warning("%s passed its deadline of %ss" % (operation.__class__.__name__, operation.deadline))
+            operation.cancel()
+
+    def _on_operation_done(self, operation: Operation):
+        # Called from the operation thread, hand over to the main thread immediately
+        sublime.set_timeout(partial(self._finish_operation, operation), 0)
+
+    def _finish_operation(self, operation: Operation):
+        # Deliver the callbacks before the key is released, so operations on the
+        # same note observe each other's results in order
+        try:
+            operation.join()
+        finally:
+            with self.__lock:
+                self.running_operations.remove(operation)
+        _show_message("Simplenote: %s finished" % operation.__class__.__name__)
+        self.schedule()
         if not self.running:
-            self.run()
-
-    def check_operations(self):
-
-        if self.current_operation == None:
-            return
-
-        # If it's still running, update the status
-        if self.current_operation.is_alive():
-            text = "Simplenote: %s staring" % self.current_operation.__class__.__name__
-        else:
-            # If not running, show finished text call callback with result and do the next operation
-            text = "Simplenote: %s finished" % self.current_operation.__class__.__name__
-            self.current_operation.join()
-            if len(self.operations) > 0:
-                self.start_next_operation()
-            else:
-                self.running = False
-                sublime.set_timeout(remove_status, 1000)
-
-        _show_message(text)
-        if self.running:
-            sublime.set_timeout(self.check_operations, 1000)
-
-    def run(self):
-        self.start_next_operation()
-        sublime.set_timeout(self.check_operations, 1000)
-        self.running = True
-
-    def start_next_operation(self):
-        self.current_operation = self.operations.popleft()
-        logger.info(self.current_operation.__class__.__name__)
-        self.current_operation.start()
+            sublime.set_timeout(remove_status, 1000)
@@ -1,7 +1,12 @@
 from datetime import datetime
+from enum import Enum
+import json
 import logging
-import pickle
-from typing import Any, Dict, List
+import os
+import sqlite3
+from threading import Lock, Thread
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
 from .._config import CONFIG
 from ..utils.patterns.singleton.base import Singleton
@@ -12,6 +17,8 @@ from .models import Note
 
 
 __all__: List[str] = [
+    "OutboxAction",
+    "NoteStore",
     "Local",
     "load_notes",
     "sort_notes",
@@ -21,70 +28,366 @@ __all__: List[str] = [
 logger = logging.getLogger()
 
 
+class OutboxAction(str, Enum):
+    """What a queued local change asks the server to do with the note"""
+
+    # Create or update the note, an unsynced note is created
+    MODIFY = "modify"
+    TRASH = "trash"
+
+
+class NoteStore:
+    """SQLite copy of the synced notes, one row per note at its latest version.
+
+    Startup only reads the metadata, titles and previews; the contents are read
+    when a note needs them, through the same interface as `ContentStore`.
+
+    Changes are appended to the write-ahead journal (`<path>-wal`), so the cost
+    of a save follows the size of the saved notes, not of the account. SQLite
+    replays the journal when the store is opened; `compact` folds it back
+    into the database file.
+
+    Local changes waiting to be uploaded are queued in `outbox`, one entry per
+    note: a newer change of the note replaces the queued one.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS notes (
+        id TEXT PRIMARY KEY,
+        v INTEGER NOT NULL,
+        tags TEXT NOT NULL,
+        deleted INTEGER NOT NULL,
+        shareURL TEXT NOT NULL,
+        systemTags TEXT NOT NULL,
+        publishURL TEXT NOT NULL,
+        modificationDate REAL NOT NULL,
+        creationDate REAL NOT NULL,
+        title TEXT NOT NULL,
+        preview TEXT NOT NULL,
+        content TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS outbox (
+        id TEXT PRIMARY KEY,
+        action TEXT NOT NULL,
+        revision INTEGER NOT NULL,
+        attempts INTEGER NOT NULL,
+        next_attempt REAL NOT NULL
+    );
+    """
+    # Seconds `compact` waits for a running save
+    COMPACT_TIMEOUT = 5
+    # The `_Note` fields stored in their own columns, in column order
+    FIELDS = ["tags", "deleted", "shareURL", "systemTags", "publishURL", "modificationDate", "creationDate"]
+
+    def __init__(self, path: str = CONFIG.SIMPLENOTE_NOTE_STORE_FILE_PATH):
+        self.path = path
+        # Written from the main thread, contents are also read from the operation threads
+        self._lock = Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            # A crash can lose the last commits but never corrupt the store, the server has them anyway
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            # Compacted by `Local` in the background instead of during a save
+            self._connection.execute("PRAGMA wal_autocheckpoint=0")
+            self._connection.executescript(self.SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    @property
+    def journal_path(self) -> str:
+        return self.path + "-wal"
+
+    def journal_size(self) -> int:
+        try:
+            return os.path.getsize(self.journal_path)
+        except OSError:
+            return 0
+
+    def compact(self):
+        """Copy the journal into the database file and truncate it"""
+        # Its own connection, saves can go on while the journal is copied
+        connection = sqlite3.connect(self.path, timeout=self.COMPACT_TIMEOUT)
+        try:
+            busy, _, _ = connection.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        finally:
+            connection.close()
+        if busy:
+            logger.debug(("Note journal compaction was interrupted: ", self.journal_path))
+
+    @staticmethod
+    def _row(note: Note) -> Tuple[Any, ...]:
+        d = note.d
+        return (
+            note.id,
+            note.v,
+            json.dumps(d.tags),
+            int(d.deleted),
+            d.shareURL,
+            json.dumps(d.systemTags),
+            d.publishURL,
+            d.modificationDate,
+            d.creationDate,
+            note.title,
+            note.preview,
+        )
+
+    def upsert(self, notes: Iterable[Note], meta: Optional[Dict[str, str]] = None):
+        """Store the notes (and `meta` values) in one transaction"""
+        with self._lock, self._connection:
+            self._write_notes(notes)
+            if meta:
+                self._connection.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", meta.items())
+
+    def _write_notes(self, notes: Iterable[Note]):
+        """Store the notes, the caller holds the lock and the transaction"""
+        with_content, without_content = [], []
+        for note in notes:
+            content = note.d._content
+            if content is None:
+                # Offloaded, the stored content is the note content
+                without_content.append(self._row(note))
+            else:
+                with_content.append(self._row(note) + (content,))
+        columns = ", ".join(self.FIELDS)
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO notes (id, v, %s, title, preview, content) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)" % columns,
+            with_content,
+        )
+        assignments = ", ".join("%s = ?" % column for column in ["v"] + self.FIELDS + ["title", "preview"])
+        self._connection.executemany(
+            "UPDATE notes SET %s WHERE id = ?" % assignments,
+            [row[1:] + row[:1] for row in without_content],
+        )
+
+    def enqueue(self, note: Note, action: OutboxAction) -> Tuple[int, bool]:
+        """Store the local state of the note and queue its upload.
+
+        Returns the revision of the queued change, and whether it replaced a change of the note not uploaded yet.
+        """
+        with self._lock, self._connection:
+            self._write_notes([note])
+            replaced = self._connection.execute("SELECT 1 FROM outbox WHERE id = ?", (note.id,)).fetchone() is not None
+            (revision,) = self._connection.execute("SELECT COALESCE(MAX(revision), 0) + 1 FROM outbox").fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO outbox (id, action, revision, attempts, next_attempt) VALUES (?, ?, ?, 0, 0)",
+                (note.id, action.value, revision),
+            )
+        return revision, replaced
+
+    def outbox(self, due: Optional[float] = None, limit: int = -1) -> List[Tuple[str, OutboxAction, int, int]]:
+        """(id, action, revision, attempts) of the queued changes, only those due at `due` if given"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id, action, revision, attempts FROM outbox WHERE next_attempt <= ? "
+                "ORDER BY next_attempt, revision LIMIT ?",
+                (float("inf") if due is None else due, limit),
+            ).fetchall()
+        return [(note_id, OutboxAction(action), revision, attempts) for note_id, action, revision, attempts in rows]
+
+    def acknowledge(self, note_id: str, revision: int, notes: Iterable[Note] = ()) -> bool:
+        """Remove an uploaded change and store the notes returned by the server, in one transaction.
+
+        Returns False, and stores nothing, when a newer change of the note was queued meanwhile.
+        """
+        with self._lock, self._connection:
+            cursor = self._connection.execute("DELETE FROM outbox WHERE id = ? AND revision = ?", (note_id, revision))
+            if cursor.rowcount != 1:
+                return False
+            self._write_notes(notes)
+        return True
+
+    def postpone(self, note_id: str, revision: int, attempts: int, next_attempt: float):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE outbox SET attempts = ?, next_attempt = ? WHERE id = ? AND revision = ?",
+                (attempts, next_attempt, note_id, revision),
+            )
+
+    def summaries(self) -> Iterator[Tuple[str, int, Dict[str, Any], Tuple[str, str]]]:
+        """(id, v, d without the content, (title, preview)) of every stored note"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id, v, %s, title, preview FROM notes" % ", ".join(self.FIELDS)
+            ).fetchall()
+        for row in rows:
+            d = dict(zip(self.FIELDS, row[2:-2]))
+            d["tags"] = json.loads(d["tags"])
+            d["systemTags"] = json.loads(d["systemTags"])
+            d["deleted"] = bool(d["deleted"])
+            yield row[0], row[1], d, (row[-2], row[-1])
+
+    def get_meta(self, key: str, default: str = "") -> str:
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    # `ContentStore` interface, see `Note.content_store`
+
+    def save(self, note_id: str, content: str) -> bool:
+        try:
+            with self._lock, self._connection:
+                cursor = self._connection.execute("UPDATE notes SET content = ? WHERE id = ?", (content, note_id))
+        except sqlite3.Error as err:
+            logger.exception(err)
+            return False
+        # Only the notes stored by `upsert` have a row to keep the content in
+        return cursor.rowcount == 1
+
+    def load(self, note_id: str) -> str:
+        with self._lock:
+            row = self._connection.execute("SELECT content FROM notes WHERE id = ?", (note_id,)).fetchone()
+        if row is None:
+            raise KeyError("Note %s is not in the note store" % note_id)
+        return row[0]
+
+    def remove(self, note_id: str) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM notes WHERE id = ?", (note_id,))
+
+
 class _BaseManager(Singleton):
     pass
 
 
 class Local(_BaseManager):
-
-    def __init__(self):
-        super().__init__()
-        self._notes: List[Dict[str, Any]] = []
-        self._objects: List[Note] = []
+    # Class attributes, `Singleton` runs `__init__` again on every `Local()`
+    _store: Optional[NoteStore] = None
+    _compaction: Optional[Thread] = None
+    # Size in bytes of the journal that triggers a compaction, see `note_journal_limit`
+    journal_limit: int = 4 * 1024 * 1024
+    # Seconds before a failed upload is tried again, doubled on every failure up to `max_retry_delay`
+    retry_delay: float = 5
+    max_retry_delay: float = 600
+    # Queued changes replaced by a newer change of their note before the upload, each an upload saved
+    superseded_changes: int = 0
 
     @property
-    def notes(self) -> List[Dict[str, Any]]:
-        return [note.d.__dict__ for note in self._objects]
-
-    @notes.setter
-    def notes(self, value: List[Dict[str, Any]]):
-        self._notes = value
+    def store(self) -> Optional[NoteStore]:
+        return self._store
 
     @property
     def objects(self) -> List[Note]:
-        return self._objects
+        return list(Note.mapper_id_note.values())
 
-    @objects.setter
-    def objects(self, value: List[Note]):
-        self._objects = value
+    def open(self, path: str = CONFIG.SIMPLENOTE_NOTE_STORE_FILE_PATH) -> NoteStore:
+        store = self._store
+        if store is None or store.path != path:
+            store = Local._store = NoteStore(path)
+        return store
 
-    @staticmethod
-    def _save_objects(SIMPLENOTE_NOTE_CACHE_FILE_PATH: str, objects: List[Note]):
-        with open(SIMPLENOTE_NOTE_CACHE_FILE_PATH, "w+b") as cache_file:
-            pickle.dump(objects, cache_file)
+    def close(self):
+        if self._compaction is not None:
+            self._compaction.join()
+        if self._store is not None:
+            self._store.close()
+            Local._store = None
 
-    @classmethod
-    def save_objects(cls):
-        return
-        cls._save_objects(CONFIG.SIMPLENOTE_NOTE_CACHE_FILE_PATH, cls._objects)
+    def compact_if_needed(self) -> bool:
+        """Compact the journal in a background thread once it outgrows `journal_limit`"""
+        store = self._store
+        if store is None or store.journal_size() <= self.journal_limit:
+            return False
+        if self._compaction is not None and self._compaction.is_alive():
+            return False
+        compaction = Local._compaction = Thread(target=self._compact, args=(store,), daemon=True)
+        compaction.start()
+        return True
 
     @staticmethod
-    def dict_to_model(note: Dict[str, Any]) -> Note:
-        d = {}
-        for key in Note.__annotations__["d"].__annotations__.keys():
-            if key in note:
-                d[key] = note[key]
-        kwargs = {
-            "id": note["key"],
-            "v": note["version"],
-            "d": note,
-        }
-        return Note(**kwargs)
-
-    # @staticmethod
-    # def model_to_dict(note: Note) -> Dict[str, Any]:
-    #     return note.d.__dict__
-
-
-def load_notes():
+    def _compact(store: NoteStore):
+        try:
+            store.compact()
+        except sqlite3.Error as err:
+            logger.exception(err)
+
+    def save_objects(self, notes: Iterable[Note], cursor: Optional[str] = None) -> bool:
+        """Persist notes as acknowledged by the server, with the sync cursor they were fetched at"""
+        if self._store is None:
+            return False
+        meta = None if cursor is None else {CONFIG.SIMPLENOTE_SYNC_CURSOR_KEY: cursor}
+        try:
+            self._store.upsert(notes, meta)
+        except sqlite3.Error as err:
+            logger.exception(err)
+            return False
+        self.compact_if_needed()
+        return True
+
+    def queue_change(self, note: Note, action: OutboxAction = OutboxAction.MODIFY) -> int:
+        """Persist a local change and queue its upload, returns its revision or 0 when it could not be queued"""
+        if self._store is None:
+            return 0
+        try:
+            revision, replaced = self._store.enqueue(note, action)
+        except sqlite3.Error as err:
+            logger.exception(err)
+            return 0
+        if replaced:
+            Local.superseded_changes += 1
+            logger.info("Superseded queued change of note %s, %s so far" % (note.id, Local.superseded_changes))
+        Note.pending_ids.add(note.id)
+        return revision
+
+    def due_changes(self, limit: int = -1) -> List[Tuple[str, OutboxAction, int, int]]:
+        """(id, action, revision, attempts) of the queued changes to upload now, oldest first"""
+        if self._store is None:
+            return []
+        return self._store.outbox(due=time.time(), limit=limit)
+
+    def change_sent(self, note_id: str, revision: int, notes: Iterable[Note] = ()) -> bool:
+        """Dequeue an uploaded change with the notes returned by the server, False if the note changed again"""
+        if self._store is None or not self._store.acknowledge(note_id, revision, notes):
+            return False
+        Note.pending_ids.discard(note_id)
+        return True
+
+    def change_failed(self, note_id: str, revision: int, attempts: int) -> float:
+        """Postpone a change that failed to upload, returns the seconds until it is tried again"""
+        delay = min(self.max_retry_delay, self.retry_delay * 2**attempts)
+        if self._store is not None:
+            self._store.postpone(note_id, revision, attempts + 1, time.time() + delay)
+        return delay
+
+    @property
+    def cursor(self) -> str:
+        if self._store is None:
+            return ""
+        return self._store.get_meta(CONFIG.SIMPLENOTE_SYNC_CURSOR_KEY)
+
+
+def load_notes(path: str = CONFIG.SIMPLENOTE_NOTE_STORE_FILE_PATH) -> int:
+    """Restore the notes of the last session from the note store, without their contents"""
+    local = Local()
     try:
-        with open(CONFIG.SIMPLENOTE_NOTE_CACHE_FILE_PATH, "rb") as cache_file:
-            Note.mapper_id_note = pickle.load(cache_file, encoding="utf-8")
-    except (EOFError, IOError, FileNotFoundError) as err:
+        store = local.open(path)
+        summaries = list(store.summaries())
+        queued = store.outbox()
+    except sqlite3.Error as err:
         logger.exception(err)
-        with open(CONFIG.SIMPLENOTE_NOTE_CACHE_FILE_PATH, "w+b") as cache_file:
-            pickle.dump(Note.mapper_id_note, cache_file)
-            logger.debug((f"Created new objects cache file: {CONFIG.SIMPLENOTE_NOTE_CACHE_FILE_PATH}"))
+        return 0
+    # The journal of the last session was replayed by opening the store
+    local.compact_if_needed()
+    Note.content_store = store
+    with Note.rebuilding_tree():
+        for note_id, v, d, summary in summaries:
+            Note.from_summary(note_id, v, d, summary)
+    for note_id, _, _, _ in queued:
+        note = Note.mapper_id_note.get(note_id)
+        if note is None:
+            continue
+        Note.pending_ids.add(note_id)
+        # The stored note is the local change, upload all of it rather than a delta
+        note._synced = ()
+    logger.debug(("Loaded notes from the note store: ", len(summaries)))
+    return len(summaries)
 
 
 def sort_notes(a_note: Note, b_note: Note):
@@ -4,6 +4,7 @@ import sublime
 
 from ._config import CONFIG
 from .lib.core import show_message, start
+from .lib.simplenote import load_notes
 
 
 logger = logging.getLogger()
@@ -29,7 +30,8 @@ def reload_if_needed():
 
 
 def plugin_loaded():
-    # load_notes()
+    # The notes of the last session are listed before the first sync returns
+    load_notes()
     settings = sublime.load_settings(CONFIG.SIMPLENOTE_SETTINGS_FILE_PATH)
     settings.clear_on_change("username")
     settings.clear_on_change("password")
@@ -0,0 +1,163 @@
+"""
+Benchmarks of the note models.
+
+Builds a synthetic corpus of notes as they arrive from the index (the dicts are
+created up front, so their content strings are not counted) and reports the
+bytes allocated per `Note`, including its `_Note`, the `Note.tree` entry and the
+lookup indexes, then the time taken by the `Note.tree` operations and by
+bulk loading the tree compared to inserting the notes one by one, and the
+cold start from the note store.
+
+    python -m tests.benchmark_models [number_of_notes]
+"""
+
+import gc
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Dict, List
+from uuid import uuid4
+
+from lib.models import Note
+from lib.simplenote import Local, load_notes
+from utils.tree.redblacktree import rbtree
+
+
+TAGS = ["work", "personal", "todo", "ideas", "journal"]
+
+
+def synthetic_corpus(number: int, seed: int = 0) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    now = time.time()
+    corpus = []
+    for i in range(number):
+        tags = rng.sample(TAGS, rng.randint(0, 2)) if i % 3 == 0 else []
+        corpus.append(
+            {
+                "id": uuid4().hex,
+                "v": rng.randint(1, 50),
+                "d": {
+                    "tags": tags,
+                    "deleted": False,
+                    "shareURL": "",
+                    "publishURL": "",
+                    "systemTags": ["markdown"] if i % 2 else [],
+                    "content": "Note %s\n%s" % (i, "lorem ipsum " * rng.randint(5, 80)),
+                    "modificationDate": now - i * 60 - rng.random(),
+                    "creationDate": now - i * 120,
+                },
+            }
+        )
+    return corpus
+
+
+def bytes_per_note(number: int = 50000) -> float:
+    corpus = synthetic_corpus(number)
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    for note in corpus:
+        Note(**note)
+    gc.collect()
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (after - before) / number
+
+
+def _reset_notes():
+    Note.mapper_id_note.clear()
+    Note.mapper_filename_note.clear()
+    Note.tree = type(Note.tree)()
+
+
+def tree_operations(number: int = 100000) -> Dict[str, float]:
+    """Seconds taken to insert, re-key and iterate `number` notes in `Note.tree`"""
+    corpus = synthetic_corpus(number)
+    # Round the dates to ten minutes, so that many notes share their modification date
+    for note in corpus:
+        note["d"]["modificationDate"] = float(int(note["d"]["modificationDate"]) // 600 * 600)
+    _reset_notes()
+    timings: Dict[str, float] = {}
+
+    start = time.perf_counter()
+    notes = [Note(**note) for note in corpus]
+    timings["insert"] = time.perf_counter() - start
+    assert Note.tree.count == number
+
+    start = time.perf_counter()
+    for note in notes:
+        note.d.modificationDate += 3600
+    timings["rekey"] = time.perf_counter() - start
+    assert Note.tree.count == number
+
+    start = time.perf_counter()
+    assert sum(1 for _ in Note.tree.iter(reverse=True)) == number
+    timings["iterate"] = time.perf_counter() - start
+    _reset_notes()
+    return timings
+
+
+def bulk_load(number: int = 100000) -> Dict[str, float]:
+    """Seconds taken to fill `Note.tree` by single inserts and by `load_sorted`, and to index
+    `number` new notes with and without `Note.rebuilding_tree`"""
+    corpus = synthetic_corpus(number)
+    timings: Dict[str, float] = {}
+
+    items = sorted(((note["d"]["modificationDate"], note["id"]), note) for note in corpus)
+    shuffled = list(items)
+    random.Random(0).shuffle(shuffled)
+    start = time.perf_counter()
+    tree = rbtree()
+    for key, value in shuffled:
+        tree.insert(key, value)
+    timings["tree insert"] = time.perf_counter() - start
+    start = time.perf_counter()
+    rbtree().load_sorted(items)
+    timings["tree load_sorted"] = time.perf_counter() - start
+
+    # The first full index of a session fills an empty tree
+    _reset_notes()
+    start = time.perf_counter()
+    for note in corpus:
+        Note(**note)
+    timings["index"] = time.perf_counter() - start
+    _reset_notes()
+    start = time.perf_counter()
+    with Note.rebuilding_tree():
+        for note in corpus:
+            Note(**note)
+    timings["index rebuilding_tree"] = time.perf_counter() - start
+    assert Note.tree.count == number
+    _reset_notes()
+    return timings
+
+
+def cold_start(number: int = 10000) -> float:
+    """Seconds taken by `load_notes` to restore `number` notes from the note store"""
+    path = os.path.join(tempfile.mkdtemp(), "notes.sqlite3")
+    _reset_notes()
+    local = Local()
+    local.open(path)
+    local.save_objects([Note(**note) for note in synthetic_corpus(number)])
+    local.close()
+    _reset_notes()
+    start = time.perf_counter()
+    assert load_notes(path) == number
+    seconds = time.perf_counter() - start
+    local.close()
+    _reset_notes()
+    return seconds
+
+
+if __name__ == "__main__":
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    print("%s notes: %.0f bytes per note" % (number, bytes_per_note(number)))
+    _reset_notes()
+    for operation, seconds in tree_operations(max(number, 100000)).items():
+        print("Note.tree %s: %.3fs" % (operation, seconds))
+    for operation, seconds in bulk_load(max(number, 100000)).items():
+        print("%s: %.3fs" % (operation, seconds))
+    print("cold start of 10000 notes: %.3fs" % cold_start(10000))
@@ -0,0 +1,77 @@
+"""
+Benchmark of the `Note.tree` index types.
+
+Times insert, remove, range slice (`index[lo:hi]`) and full reverse iteration
+of every type in `INDEX_TYPES` with keys shaped like `Note.tree_key`.
+
+    python -m tests.benchmark_tree [number_of_entries ...]
+"""
+
+import random
+import sys
+import time
+from typing import Any, Dict, List, Tuple
+from uuid import uuid4
+
+from utils.tree.index import INDEX_TYPES, SortedIndex
+
+
+SLICES = 100
+
+
+def synthetic_keys(number: int, seed: int = 0) -> List[Tuple[float, str]]:
+    rng = random.Random(seed)
+    now = time.time()
+    return [(now - rng.random() * 365 * 86400, uuid4().hex) for _ in range(number)]
+
+
+def measure(name: str, number: int) -> Dict[str, float]:
+    keys = synthetic_keys(number)
+    rng = random.Random(1)
+    timings: Dict[str, float] = {}
+
+    start = time.perf_counter()
+    index: SortedIndex = INDEX_TYPES[name]()
+    for key in keys:
+        index.insert(key, key)
+    timings["insert"] = time.perf_counter() - start
+
+    ordered = sorted(keys)
+    bounds = []
+    for _ in range(SLICES):
+        # About 1% of the entries per slice
+        lo = rng.randrange(number)
+        bounds.append((ordered[lo], ordered[min(lo + number // 100, number - 1)]))
+    start = time.perf_counter()
+    for lo, hi in bounds:
+        index[lo:hi]
+    timings["slice"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in index.iter(reverse=True):
+        pass
+    timings["reverse iter"] = time.perf_counter() - start
+
+    rng.shuffle(keys)
+    start = time.perf_counter()
+    for key in keys:
+        index.remove(key)
+    timings["remove"] = time.perf_counter() - start
+    assert len(index) == 0
+    return timings
+
+
+def compare(numbers: List[int]) -> List[Dict[str, Any]]:
+    rows = []
+    for number in numbers:
+        for name in INDEX_TYPES:
+            rows.append(dict(index=name, entries=number, **measure(name, number)))
+    return rows
+
+
+if __name__ == "__main__":
+    numbers = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]
+    columns = ["insert", "remove", "slice", "reverse iter"]
+    print("%-12s %8s " % ("index", "entries") + " ".join("%12s" % column for column in columns))
+    for row in compare(numbers):
+        print("%-12s %8s " % (row["index"], row["entries"]) + " ".join("%11.4fs" % row[c] for c in columns))
@@ -1,9 +1,20 @@
+from email.message import Message
 from importlib import import_module
+import json
 import logging
-from typing import Any
-from unittest import TestCase, main
+import sys
+from threading import Thread
+from typing import Any, Callable, Dict, List, Optional
+from unittest import TestCase, main, mock
+from uuid import uuid4
 
+from _config import CONFIG
+from lib.api import Simplenote, SimplenoteCursorRejected, SimplenoteVersionConflict
+from lib.core import global_storage
 from lib.models import Note, _Note
+from lib.operations import NotesIndicator
+from utils.request import Response
+from utils.tree.sortedarray import sortedarray
 
 
 import_module("utils.logger.init")
@@ -34,7 +45,7 @@ class TestNote(TestCase):
         assert note.v == 2
         assert isinstance(note, Note)
         assert note.d.content == content
-        logger.info(note.__dict__)
+        logger.info(note.d._nest_dict())
 
     def test_mapper_id_note(self):
         _d_kwargs["id"] = "001"
@@ -131,7 +142,7 @@ class TestNote(TestCase):
         # check same id
         note = Note(**_d_kwargs)
         assert Note.tree.count == 1
-        find_note1 = Note.tree.find(note.d.modificationDate)
+        find_note1 = Note.tree.find(note.tree_key)
         logger.info(find_note1)
         logger.info(note.d.modificationDate)
         logger.info([note.d.modificationDate for note in Note.tree.iter()])
@@ -144,7 +155,7 @@ class TestNote(TestCase):
         note2 = Note(**_d_kwargs)
         logger.info((note.id, note, note2.id, note2))
         assert note is note2
-        find_note2 = Note.tree.find(note2.d.modificationDate)
+        find_note2 = Note.tree.find(note2.tree_key)
         logger.info((note.id, note, find_note2.id, find_note2))
         assert note is find_note2
         assert note.d.modificationDate == find_note2.d.modificationDate
@@ -170,6 +181,19 @@ class TestNote(TestCase):
         # check order is restored after modificationDate is changed
         note3.d.modificationDate = 0
         logger.info([note.d.modificationDate for note in Note.tree.iter()])
+        assert list(Note.tree.iter()) == [note3, note]
+        assert Note.tree.count == 2
+
+    def test_note_tree_same_modification_date(self):
+        notes = [Note(id=uuid4().hex, v=1, d=dict(_note_kwargs, modificationDate=1.5)) for _ in range(3)]
+        assert all(Note.tree.find(note.tree_key) is note for note in notes)
+        same_date = [note for note in Note.tree.iter() if note in notes]
+        assert same_date == sorted(notes, key=lambda note: note.id)
+        # Re-keying one of them leaves the others in place
+        notes[0].d.modificationDate = 2.5
+        assert Note.tree.find((1.5, notes[0].id)) is None
+        assert Note.tree.find(notes[0].tree_key) is notes[0]
+        assert all(Note.tree.find(note.tree_key) is note for note in notes[1:])
 
     def test__note__nest_dict(self):
         validate_result = {
@@ -188,7 +212,7 @@ class TestNote(TestCase):
         # logger.info(asdict(note.d))
         logger.info(note.d._nest_dict())
         assert validate_result.keys() == note.d._nest_dict().keys()
-        assert "_modificationDate" in note.d.__dict__
+        assert "_modificationDate" in note.d.__slots__
 
     def test_get_title_body(self):
         list_content = [
@@ -207,5 +231,231 @@ class TestNote(TestCase):
             assert body.startswith("SimplenoteBody")
 
 
+class TestNoteThreads(TestCase):
+    def setUp(self):
+        # Small blocks split and merge often, which widens the window of a race
+        for name, value in [("tree", sortedarray(load=4)), ("mapper_id_note", {}), ("mapper_filename_note", {})]:
+            patcher = mock.patch.object(Note, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_concurrent_rekey(self):
+        """Operations of different keys create and re-key notes on several threads at once"""
+        errors: List[Exception] = []
+
+        def create_and_rekey(offset: int):
+            try:
+                for i in range(2000):
+                    d = {"tags": [], "content": "note %s" % i, "modificationDate": offset + i}
+                    note = Note(id=uuid4().hex, v=1, d=d)
+                    note.d.modificationDate = offset - i
+            except Exception as err:
+                errors.append(err)
+
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [Thread(target=create_and_rekey, args=(n * 1000,)) for n in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(switch_interval)
+        assert errors == []
+        keys = [key for key, _ in Note.tree.range()]
+        assert keys == sorted(keys)
+        assert len(keys) == Note.tree.count == len(Note.mapper_id_note) == 8000
+        assert all(Note.tree.find(note.tree_key) is note for note in Note.mapper_id_note.values())
+
+
+class FakeSimperium:
+    """Local stand-in of the Simperium object and index endpoints: posted fields are merged into the
+    stored note, and the index lists the notes in change order with `current` and `mark`"""
+
+    # The `since` the index rejects, like a change version the server no longer keeps
+    EXPIRED_CURSOR = "expired"
+
+    def __init__(self):
+        self.notes: Dict[str, Dict[str, Any]] = {}
+        self.uploads: List[Dict[str, Any]] = []
+        # Change version of the account, and note id -> change version of its last change
+        self.current = 0
+        self.changes: Dict[str, int] = {}
+        # The arguments of every `index` call
+        self.index_calls: List[Dict[str, Any]] = []
+        # Called after an index page is served, e.g. to change a note during a sync
+        self.on_index_page: Optional[Callable[[], Any]] = None
+
+    def modify(self, note: Dict[str, Any], note_id: str, version: Optional[int] = None):
+        stored = self.notes.setdefault(note_id, {"v": 0, "d": {}})
+        if version is not None and version != stored["v"]:
+            raise SimplenoteVersionConflict(note_id, version, Response(412, Message(), ""))
+        # Round-trip through JSON like the wire does
+        note = json.loads(json.dumps(note))
+        self.uploads.append(note)
+        stored["d"].update(note)
+        stored["v"] += 1
+        self.current += 1
+        self.changes[note_id] = self.current
+        return {"id": note_id, "v": stored["v"], "d": dict(stored["d"])}
+
+    def index(
+        self,
+        limit: int = 1000,
+        data: bool = False,
+        since: Optional[str] = None,
+        mark: Optional[str] = None,
+        item: Optional[Callable[[Dict[str, Any]], Any]] = None,
+    ) -> Dict[str, Any]:
+        self.index_calls.append({"limit": limit, "since": since, "mark": mark, "item": item})
+        if since == self.EXPIRED_CURSOR:
+            raise SimplenoteCursorRejected(since, Response(400, Message(), ""))
+        changed = sorted(
+            (change, note_id) for note_id, change in self.changes.items() if not since or change > int(since)
+        )
+        start = int(mark or 0)
+        notes = [
+            {"id": note_id, "v": self.notes[note_id]["v"], "d": dict(self.notes[note_id]["d"])}
+            for _, note_id in changed[start : start + limit]
+        ]
+        if item is not None:
+            notes = [note for note in map(item, notes) if note is not None]
+        page: Dict[str, Any] = {"current": str(self.current), "index": notes}
+        if start + limit < len(changed):
+            page["mark"] = str(start + limit)
+        if self.on_index_page is not None:
+            self.on_index_page()
+        return page
+
+    # The real walk over the pages of `index`
+    iter_index = Simplenote.iter_index
+
+
+class TestNoteModify(TestCase):
+    def setUp(self):
+        self.server = FakeSimperium()
+        patcher = mock.patch.object(Note, "API", self.server)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def _fields(**kwargs) -> Dict[str, Any]:
+        """Fresh note fields, `Note` stores itself in the dict it is given like in `_note_kwargs`"""
+        fields = {"tags": [], "deleted": False, "systemTags": [], "content": content, "modificationDate": 0}
+        fields.update(kwargs)
+        return fields
+
+    def _synced_note(self, content: str) -> Note:
+        note_id = uuid4().hex
+        _note = self.server.modify(self._fields(content=content), note_id)
+        self.server.uploads.clear()
+        return Note(**_note)
+
+    def test_unsynced_note_uploads_all_fields(self):
+        note = Note(id=uuid4().hex, d=self._fields())
+        note.modify()
+        assert self.server.uploads[0].keys() >= set(note.d._nest_dict().keys())
+
+    def test_delta_upload_round_trip(self):
+        note = self._synced_note("title\n" + "body\n" * 1000)
+        note.content = note.d.content + "one more line"
+        expected = json.loads(json.dumps(note.d._nest_dict()))
+        note = note.modify()
+        upload = self.server.uploads[0]
+        assert set(upload.keys()) == {"content"}
+        stored = self.server.notes[note.id]["d"]
+        for key in ("content", "tags", "systemTags", "deleted"):
+            assert stored[key] == expected[key]
+        assert note.d.content == expected["content"]
+        assert note.changes() == {}
+
+    def test_version_conflict_falls_back_to_full_upload(self):
+        note = self._synced_note("title\nbody")
+        # Another client changed the note in the meantime
+        self.server.modify({"tags": ["other"]}, note.id)
+        self.server.uploads.clear()
+        note.content = "title\nnew body"
+        note = note.modify()
+        assert len(self.server.uploads) == 1
+        assert self.server.uploads[0]["content"] == "title\nnew body"
+        assert "tags" in self.server.uploads[0]
+
+
+class TestNotesIndicator(TestCase):
+    def setUp(self):
+        self.server = FakeSimperium()
+        for name, value in [
+            ("API", self.server),
+            ("tree", sortedarray()),
+            ("mapper_id_note", {}),
+            ("mapper_filename_note", {}),
+            ("pending_ids", set()),
+        ]:
+            patcher = mock.patch.object(Note, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.note_ids = [uuid4().hex for _ in range(5)]
+        for i, note_id in enumerate(self.note_ids):
+            self.server.modify({"content": "note %s" % i, "modificationDate": i}, note_id)
+
+    def _sync(self, cursor: str = "") -> NotesIndicator:
+        indicator = NotesIndicator(sync_note_number=2, cursor=cursor)
+        indicator.result = indicator.execute()
+        return indicator
+
+    def test_incremental_sync(self):
+        indicator = self._sync()
+        assert sorted(note.id for note in indicator.result) == sorted(self.note_ids)
+        assert [call["since"] for call in self.server.index_calls] == [None, None, None]
+        assert indicator.cursor == "5"
+        assert global_storage.get(CONFIG.SIMPLENOTE_SYNC_CURSOR_KEY) == "5"
+
+        self.server.modify({"content": "edited"}, self.note_ids[1])
+        self.server.index_calls.clear()
+        indicator = self._sync(indicator.cursor)
+        assert [note.id for note in indicator.result] == [self.note_ids[1]]
+        assert indicator.result[0].d.content == "edited"
+        assert [call["since"] for call in self.server.index_calls] == ["5"]
+        assert indicator.cursor == "6"
+
+    def test_cursor_of_the_first_page(self):
+        # Another client changes a note while the pages are fetched, the next sync picks it up
+        self.server.on_index_page = lambda: self.server.modify({"content": "meanwhile"}, self.note_ids[0])
+        indicator = self._sync()
+        assert indicator.cursor == "5"
+        self.server.on_index_page = None
+        indicator = self._sync(indicator.cursor)
+        assert self.note_ids[0] in [note.id for note in indicator.result]
+        assert Note.mapper_id_note[self.note_ids[0]].d.content == "meanwhile"
+
+    def test_iter_index_follows_mark(self):
+        for i in range(4):
+            note_id = uuid4().hex
+            self.note_ids.append(note_id)
+            self.server.modify({"content": "more %s" % i}, note_id)
+
+        def item(note: Dict[str, Any]) -> str:
+            return note["id"]
+
+        pages = list(self.server.iter_index(limit=2, since="2", item=item))
+        # The 7 notes changed after "2", the last page has no mark
+        assert [page["index"] for page in pages] == [self.note_ids[i : i + 2] for i in range(2, 9, 2)]
+        assert [page.get("mark") for page in pages] == ["2", "4", "6", None]
+        assert [(call["since"], call["mark"], call["item"]) for call in self.server.index_calls] == [
+            ("2", None, item),
+            ("2", "2", item),
+            ("2", "4", item),
+            ("2", "6", item),
+        ]
+
+    def test_rejected_cursor_falls_back_to_a_full_index(self):
+        indicator = self._sync(FakeSimperium.EXPIRED_CURSOR)
+        assert sorted(note.id for note in indicator.result) == sorted(self.note_ids)
+        assert [call["since"] for call in self.server.index_calls] == [FakeSimperium.EXPIRED_CURSOR, None, None, None]
+        assert indicator.cursor == "5"
+        assert Note.tree.count == 5
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,303 @@
+from threading import Event, Lock
+import time
+from typing import Any, Callable, List, Optional, Tuple
+from unittest import TestCase, main, mock
+from uuid import uuid4
+
+import sublime
+
+from _config import CONFIG
+from commands import SimplenoteSyncCommand
+from lib.core import global_storage
+from lib.models import Note
+from lib.operations import (
+    MultipleNoteDownloader,
+    NoteUpdater,
+    Operation,
+    OperationCancelled,
+    OperationPriority,
+    OperationTimedOut,
+    Operator,
+)
+from utils.request import DeadlineExceeded, remaining_time
+from utils.tree.sortedarray import sortedarray
+
+
+def _isolate_notes(test: TestCase):
+    """Give the test its own note indexes"""
+    for name, value in [
+        ("tree", sortedarray()),
+        ("mapper_id_note", {}),
+        ("mapper_filename_note", {}),
+        ("pending_ids", set()),
+    ]:
+        patcher = mock.patch.object(Note, name, value)
+        patcher.start()
+        test.addCleanup(patcher.stop)
+
+
+class _MainThread:
+    """`sublime.set_timeout` for the tests: the callbacks run on the test thread when `run_until` pumps them.
+
+    They cannot run inline, the operation thread hands its completion over with `set_timeout`
+    and the completion joins that thread.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._timers: List[Tuple[float, Callable[[], Any]]] = []
+
+    def set_timeout(self, callback: Callable[[], Any], delay: int = 0):
+        with self._lock:
+            self._timers.append((time.monotonic() + delay / 1000, callback))
+
+    def run_until(self, condition: Callable[[], Any], timeout: float = 5):
+        end = time.monotonic() + timeout
+        while not condition():
+            now = time.monotonic()
+            assert now < end, "timed out"
+            with self._lock:
+                due = [timer for timer in self._timers if timer[0] <= now]
+                self._timers = [timer for timer in self._timers if timer[0] > now]
+            for _, callback in due:
+                callback()
+            if not due:
+                time.sleep(0.005)
+
+
+class _Stub(Operation):
+    """Runs until released or cancelled, recording ("start" | "end" | "cancelled", name) in `log`"""
+
+    deadline = None
+
+    def __init__(self, name: str, log: List[Tuple[str, str]], key: Optional[str] = None):
+        super().__init__()
+        self.name = name
+        self.log = log
+        self._key = key
+        self.started = Event()
+        self.release = Event()
+
+    @property
+    def key(self) -> Optional[str]:
+        return self._key
+
+    def execute(self):
+        self.log.append(("start", self.name))
+        self.started.set()
+        while not self.release.wait(0.01):
+            if self.cancelled:
+                self.log.append(("cancelled", self.name))
+                raise OperationCancelled(self)
+        self.log.append(("end", self.name))
+        return self.name
+
+
+class _Save(_Stub):
+    priority = OperationPriority.SAVE
+
+
+class _Sync(_Stub):
+    priority = OperationPriority.SYNC
+
+
+class _Expiring(_Stub):
+    deadline = 0.1
+
+
+class _Overrun(Operation):
+    """Keeps going past its deadline, then fails with `error` the way a request cut short does"""
+
+    deadline = 0.1
+
+    def __init__(self, error: Exception):
+        super().__init__()
+        self.error = error
+
+    def execute(self):
+        while (remaining_time() or 0) > 0:
+            time.sleep(0.01)
+        time.sleep(0.05)
+        raise self.error
+
+
+def _max_running(log: List[Tuple[str, str]], names: Optional[List[str]] = None) -> int:
+    """The most operations among `names`, or all of them, running at once in `log`"""
+    running = most = 0
+    for event, name in log:
+        if names is None or name in names:
+            running += 1 if event == "start" else -1
+            most = max(most, running)
+    return most
+
+
+class TestOperator(TestCase):
+    def setUp(self):
+        self.main = _MainThread()
+        patcher = mock.patch.object(sublime, "set_timeout", self.main.set_timeout)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.log: List[Tuple[str, str]] = []
+        self.results: List[str] = []
+        self.stubs: List[_Stub] = []
+        self.addCleanup(self._finish)
+
+    def _finish(self):
+        for stub in self.stubs:
+            stub.release.set()
+        self.main.run_until(lambda: not self.operator.running)
+
+    def _add(self, stub: _Stub) -> _Stub:
+        self.stubs.append(stub)
+        stub.set_callback(self.results.append)
+        self.operator.add_operation(stub)
+        return stub
+
+    def test_save_queued_behind_a_sync_starts_next(self):
+        self.operator = Operator(max_workers=1)
+        sync = self._add(_Sync("sync", self.log))
+        modify = self._add(_Stub("modify", self.log))
+        save = self._add(_Save("save", self.log))
+        assert sync.started.wait(5)
+        sync.release.set()
+        self.main.run_until(save.started.is_set)
+        assert not modify.started.is_set()
+        save.release.set()
+        modify.release.set()
+        self.main.run_until(lambda: not self.operator.running)
+        assert [name for event, name in self.log if event == "start"] == ["sync", "save", "modify"]
+        assert self.results == ["sync", "save", "modify"]
+
+    def test_operations_of_a_key_never_overlap(self):
+        self.operator = Operator(max_workers=3)
+        first = self._add(_Stub("first", self.log, key="note"))
+        second = self._add(_Stub("second", self.log, key="note"))
+        other = self._add(_Stub("other", self.log, key="other"))
+        # The callbacks of an operation are delivered before the next one of its key starts
+        first.set_callback(lambda result: self.results.append("second started: %s" % second.started.is_set()))
+        assert first.started.wait(5) and other.started.wait(5)
+        assert self.operator.running_operations == [first, other]
+        assert not second.started.is_set()
+        first.release.set()
+        self.main.run_until(second.started.is_set)
+        assert self.log.index(("end", "first")) < self.log.index(("start", "second"))
+        assert self.results == ["second started: False"]
+        assert _max_running(self.log, ["first", "second"]) == 1
+
+    def test_max_workers(self):
+        self.operator = Operator(max_workers=2)
+        stubs = [self._add(_Stub("stub %s" % i, self.log)) for i in range(5)]
+        self.main.run_until(lambda: len(self.log) == 2)
+        assert len(self.operator.running_operations) == 2
+        assert len(self.operator.operations) == 3
+        for stub in stubs:
+            stub.release.set()
+        self.main.run_until(lambda: not self.operator.running)
+        assert sorted(self.results) == sorted(stub.name for stub in stubs)
+        assert _max_running(self.log) == 2
+
+    def test_cancelled_operation_runs_its_exception_callback(self):
+        self.operator = Operator(max_workers=1)
+        running = self._add(_Stub("running", self.log, key="note"))
+        pending = self._add(_Stub("pending", self.log, key="note"))
+        errors: List[Exception] = []
+        running.set_exception_callback(errors.append)
+        assert running.started.wait(5)
+        self.operator.cancel("note")
+        self.main.run_until(lambda: errors)
+        assert type(errors[0]) is OperationCancelled
+        assert self.results == []
+        # The pending operation was dropped without running
+        assert not pending.started.is_set()
+        assert not self.operator.running
+
+    def test_quick_saves_of_a_note_upload_once(self):
+        _isolate_notes(self)
+        self.operator = Operator(max_workers=3)
+        note = Note(id=uuid4().hex, v=1, d={"content": "title\nbody"})
+        # An earlier upload of the note is still running
+        running = self._add(_Stub("running", self.log, key=note.id))
+        assert running.started.wait(5)
+        saved: List[Note] = []
+        with mock.patch.object(Note, "modify", autospec=True, side_effect=lambda note: note) as modify:
+            updaters = [NoteUpdater(note=note) for _ in range(3)]
+            for updater in updaters:
+                updater.set_callback(saved.append)
+                self.operator.add_operation(updater)
+            assert [updater.cancelled for updater in updaters] == [True, True, False]
+            assert self.operator.superseded == {"NoteUpdater": 2}
+            running.release.set()
+            self.main.run_until(lambda: not self.operator.running)
+        assert modify.call_count == 1
+        assert saved == [note]
+
+    def test_operation_overrunning_its_deadline_times_out(self):
+        self.operator = Operator(max_workers=2)
+        errors: List[Exception] = []
+        # Refused by the request before it is sent, or cut short by the socket timeout
+        overruns = [_Overrun(DeadlineExceeded()), _Overrun(ConnectionError("read timed out"))]
+        with mock.patch("lib.operations._show_message") as show_message:
+            for overrun in overruns:
+                overrun.set_exception_callback(errors.append)
+                self.operator.add_operation(overrun)
+            self.main.run_until(lambda: len(errors) == 2 and not self.operator.running)
+        assert [type(error) for error in errors] == [OperationTimedOut, OperationTimedOut]
+        assert all(overrun.result in errors for overrun in overruns)
+        show_message.assert_any_call("Simplenote: %s" % errors[0])
+
+    def test_timed_out_sync_resets_its_started_flag(self):
+        self.operator = Operator(max_workers=1)
+        self.addCleanup(global_storage.optimistic_update, CONFIG.SIMPLENOTE_STARTED_KEY, False)
+        global_storage.optimistic_update(CONFIG.SIMPLENOTE_STARTED_KEY, True)
+        overrun = _Overrun(DeadlineExceeded())
+        overrun.set_exception_callback(SimplenoteSyncCommand().exception_callback)
+        self.operator.add_operation(overrun)
+        self.main.run_until(lambda: not self.operator.running)
+        assert type(overrun.result) is OperationTimedOut
+        assert global_storage.get(CONFIG.SIMPLENOTE_STARTED_KEY) is False
+
+    def test_expire_cancels_a_running_operation(self):
+        self.operator = Operator(max_workers=1)
+        errors: List[Exception] = []
+        # Never released, only the timer set at its start stops it
+        expiring = self._add(_Expiring("expiring", self.log))
+        expiring.set_exception_callback(errors.append)
+        self.main.run_until(lambda: errors)
+        assert expiring.cancelled
+        assert self.log == [("start", "expiring"), ("cancelled", "expiring")]
+        assert type(errors[0]) is OperationTimedOut
+        assert self.results == []
+
+
+class TestMultipleNoteDownloader(TestCase):
+    def setUp(self):
+        _isolate_notes(self)
+        patcher = mock.patch.object(sublime, "set_timeout")
+        self.set_timeout = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_results_and_progress(self):
+        notes = [Note(id=uuid4().hex, v=1, d={"content": "note %s" % i}) for i in range(4)]
+        failing = notes[1].id
+        error = ConnectionError("connection reset")
+
+        def retrieve(note_id: str) -> Note:
+            if note_id == failing:
+                raise error
+            return Note.mapper_id_note[note_id]
+
+        downloader = MultipleNoteDownloader(notes, max_workers=2)
+        with mock.patch.object(Note, "retrieve", side_effect=retrieve):
+            with self.assertRaises(ConnectionError) as raised:
+                downloader.execute()
+        # The first failure is the result, every note keeps its own
+        assert raised.exception is error
+        assert downloader.results[failing] is error
+        assert all(downloader.results[note.id] is note for note in notes if note.id != failing)
+        assert downloader.progress == (4, 4)
+        messages = [call.args[0].args[0] for call in self.set_timeout.call_args_list]
+        assert messages == ["Simplenote: MultipleNoteDownloader %s/4" % done for done in range(1, 5)]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,431 @@
+from email.message import Message
+import gzip
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import socket
+from threading import Lock, Thread
+import time
+from unittest import TestCase, main, mock, skipIf
+import zlib
+
+from utils.request import (
+    ACCEPT_ENCODING,
+    ConnectionPool,
+    ContentDecoding,
+    DeadlineExceeded,
+    JSONStream,
+    Response,
+    RetryPolicy,
+    Timeout,
+    connection_pool,
+    deadline,
+    iter_json_members,
+    request,
+    request_metrics,
+)
+
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+logger = logging.getLogger()
+
+
+INDEX_PAGE = {
+    "current": "5f0c",
+    "index": [
+        {"id": "%032d" % i, "v": i, "d": {"content": 'note %s \u00e9\u4e2d "quoted"' % i, "modificationDate": i + 0.5}}
+        for i in range(300)
+    ],
+    "mark": "5f0d",
+}
+
+
+def _compress(kind: str, body: bytes) -> bytes:
+    if kind == "gzip":
+        return gzip.compress(body)
+    if kind == "gzip-members":
+        # Concatenated gzip members are a valid gzip body
+        half = len(body) // 2
+        return gzip.compress(body[:half]) + gzip.compress(body[half:])
+    if kind == "deflate":
+        return zlib.compress(body)
+    if kind == "deflate-raw":
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush()
+    if kind == "br":
+        return brotli.compress(body)
+    if kind == "gzip-truncated":
+        return gzip.compress(body)[:-100]
+    raise ValueError(kind)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # path -> number of requests, `/flaky/<n>` fails the first n requests of a path
+    hits = {}
+    hits_lock = Lock()
+
+    def _flaky(self) -> bool:
+        """Answer 503 if the path is still failing"""
+        with self.hits_lock:
+            self.hits[self.path] = hits = self.hits.get(self.path, 0) + 1
+        if hits > int(self.path.split("/")[2]):
+            return False
+        body = b"unavailable"
+        self.send_response(503)
+        self.send_header("Retry-After", "0")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return True
+
+    def _drop(self) -> bool:
+        """`/drop` closes the connection without answering, like a keep-alive timeout racing a request"""
+        if not self.path.startswith("/drop"):
+            return False
+        with self.hits_lock:
+            self.hits[self.path] = self.hits.get(self.path, 0) + 1
+        self.close_connection = True
+        return True
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send_json(self, status: int, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self._drop():
+            return
+        if self.path.startswith("/flaky") and self._flaky():
+            return
+        if self.path.startswith("/slow"):
+            # A stalled server, `/slow/<seconds>` answers after that long
+            time.sleep(float(self.path.split("/")[2]))
+        if self.path.startswith("/encoded"):
+            kind = self.path.split("/")[2]
+            body = _compress(kind, json.dumps(INDEX_PAGE).encode())
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json; charset=UTF-8")
+            self.send_header("Content-Encoding", kind.split("-")[0])
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path.startswith("/headers"):
+            self._send_json(200, dict(self.headers))
+            return
+        if self.path.startswith("/index-page"):
+            self._send_json(200, INDEX_PAGE)
+            return
+        if self.path.startswith("/missing"):
+            self._send_json(404, {"error": "not found"})
+            return
+        self._send_json(200, {"path": self.path, "port": self.client_address[1]})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        if self._drop():
+            return
+        if self.path.startswith("/flaky") and self._flaky():
+            return
+        self._send_json(200, payload)
+
+
+class TestRequest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        cls.url = "http://127.0.0.1:%s" % cls.server.server_address[1]
+        Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        connection_pool.clear()
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        connection_pool.clear()
+        request_metrics.clear()
+        _Handler.hits.clear()
+
+    def test_request_reuses_connection(self):
+        before = connection_pool.stats()
+        responses = [request(self.url + "/index", method="GET", headers={"Accept": "*/*"}) for _ in range(5)]
+        after = connection_pool.stats()
+        assert [response.status for response in responses] == [200] * 5
+        # Every request was served from the same client socket
+        assert len({response.data["port"] for response in responses}) == 1
+        assert after["misses"] - before["misses"] == 1
+        assert after["hits"] - before["hits"] == 4
+        assert after["open"] == 1
+
+    def test_post_json(self):
+        response = request(self.url + "/i/1", method="POST", headers={"Accept": "*/*"}, data={"content": "note"})
+        assert response.status == 200
+        assert response.data == {"content": "note"}
+
+    def test_error_status(self):
+        response = request(self.url + "/missing", method="GET", headers={"Accept": "*/*"})
+        assert response.status == 404
+        assert response.error_count == 1
+        # The error body was read completely, so the connection is still reusable
+        assert connection_pool.stats()["idle"] == 1
+
+    def test_idle_eviction(self):
+        pool = ConnectionPool(maxsize=1, idle_timeout=0)
+        with pool.urlopen("GET", self.url + "/index") as response:
+            response.read()
+        assert pool.stats()["open"] == 1
+        with pool.urlopen("GET", self.url + "/index") as response:
+            response.read()
+        stats = pool.stats()
+        assert stats["misses"] == 2
+        assert stats["hits"] == 0
+        pool.clear()
+
+    def test_maxsize(self):
+        pool = ConnectionPool(maxsize=1)
+        with pool.urlopen("GET", self.url + "/a") as first, pool.urlopen("GET", self.url + "/b") as second:
+            first.read()
+            second.read()
+            assert pool.stats()["in_use"] == 2
+        assert pool.stats()["open"] == 1
+        pool.clear()
+
+    def test_stale_connection(self):
+        pool = ConnectionPool()
+        for method in ("GET", "POST"):
+            with pool.urlopen("GET", self.url + "/index") as response:
+                response.read()
+            # The dropped request reached the server, a POST must not be sent twice
+            with self.assertRaises(ConnectionError):
+                with pool.urlopen(method, self.url + "/drop/" + method, body=b"{}") as response:
+                    response.read()
+        assert _Handler.hits == {"/drop/GET": 2, "/drop/POST": 1}
+        pool.clear()
+
+    def test_retry_transient_status(self):
+        response = request(self.url + "/flaky/2", headers={"Accept": "*/*"}, retry=RetryPolicy(backoff=0))
+        assert response.status == 200
+        assert response.attempts == 3
+        assert response.error_count == 2
+        assert request_metrics.stats() == {"calls": 1, "attempts": 3, "retries": 2, "failed": 0}
+        assert request_metrics.attempts_per_call() == {3: 1}
+
+    def test_retry_gives_up(self):
+        response = request(self.url + "/flaky/9", headers={"Accept": "*/*"}, retry=RetryPolicy(retries=2, backoff=0))
+        assert response.status == 503
+        assert response.attempts == 3
+        assert request_metrics.stats()["failed"] == 1
+
+    def test_post_is_not_retried(self):
+        response = request(self.url + "/flaky/1", method="POST", headers={"Accept": "*/*"}, data={"a": 1})
+        assert response.status == 503
+        assert response.attempts == 1
+        assert _Handler.hits == {"/flaky/1": 1}
+
+    def test_retry_connection_error(self):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        # Nothing listens on the port any more, every attempt is refused
+        response = request("http://127.0.0.1:%s/" % port, headers={"Accept": "*/*"}, retry=RetryPolicy(backoff=0))
+        assert response.status == 500
+        assert response.attempts == 4
+
+    def test_stream_index(self):
+        ids = []
+
+        def item(note):
+            ids.append(note["id"])
+            return None if note["v"] % 2 else note
+
+        response = request(self.url + "/index-page", headers={"Accept": "*/*"}, stream=JSONStream("index", item))
+        assert response.status == 200
+        assert response.body == ""
+        assert ids == [note["id"] for note in INDEX_PAGE["index"]]
+        assert response.data == dict(INDEX_PAGE, index=INDEX_PAGE["index"][::2])
+        # The connection was read to the end and can be reused
+        assert connection_pool.stats()["idle"] == 1
+
+    def test_data_is_parsed_once(self):
+        response = request(self.url + "/index-page", headers={"Accept": "*/*"})
+        assert response.data == INDEX_PAGE
+        assert response.data is response.json()
+        assert response._replace(attempts=2).data is response.data
+
+    def test_compressed_bodies(self):
+        kinds = ["gzip", "gzip-members", "deflate", "deflate-raw"] + (["br"] if brotli else [])
+        for kind in kinds:
+            url = self.url + "/encoded/" + kind
+            response = request(url, headers={"Accept": "*/*"})
+            assert response.status == 200, kind
+            assert json.loads(response.body) == INDEX_PAGE, kind
+            # Small reads split the compressed stream and the UTF-8 characters
+            with mock.patch("utils.request.STREAM_CHUNK_SIZE", 7):
+                response = request(url, headers={"Accept": "*/*"}, stream=JSONStream("index"))
+            assert response.status == 200, kind
+            assert response.data == INDEX_PAGE, kind
+
+    def test_truncated_compressed_body(self):
+        response = request(self.url + "/encoded/gzip-truncated", headers={"Accept": "*/*"})
+        assert response.status == 500
+        assert response.attempts == 1
+
+    def test_accept_encoding(self):
+        response = request(self.url + "/headers", headers={"Accept": "*/*"})
+        assert response.data["Accept-Encoding"] == ACCEPT_ENCODING
+        assert ACCEPT_ENCODING.split(", ")[:2] == ["gzip", "deflate"]
+        assert ("br" in ACCEPT_ENCODING) == (brotli is not None)
+
+    def test_read_timeout(self):
+        start = time.monotonic()
+        response = request(
+            self.url + "/slow/1", headers={"Accept": "*/*"}, retry=RetryPolicy(retries=0), timeout=Timeout(read=0.2)
+        )
+        assert response.status == 500
+        assert time.monotonic() - start < 0.9
+
+    def test_deadline_bounds_the_retries(self):
+        start = time.monotonic()
+        with deadline(0.5):
+            self.assertRaises(
+                DeadlineExceeded, request, self.url + "/slow/1", headers={"Accept": "*/*"}, retry=RetryPolicy(backoff=0)
+            )
+            self.assertRaises(DeadlineExceeded, request, self.url + "/index", headers={"Accept": "*/*"})
+        assert time.monotonic() - start < 0.9
+        assert request_metrics.stats()["failed"] == 1
+        # Outside of the deadline requests are bounded by their timeout only
+        assert request(self.url + "/index", headers={"Accept": "*/*"}).status == 200
+
+    def test_deadline_expires_during_a_request(self):
+        start = time.monotonic()
+        with deadline(0.3):
+            with self.assertRaises(DeadlineExceeded):
+                request(self.url + "/slow/1", headers={"Accept": "*/*"}, retry=RetryPolicy(retries=0))
+        assert time.monotonic() - start < 0.7
+        # A response that comes in time is returned, even an error
+        with deadline(5):
+            assert request(self.url + "/missing", headers={"Accept": "*/*"}).status == 404
+
+    def test_deadline_leaves_no_time_to_retry(self):
+        with deadline(0.5), mock.patch.object(RetryPolicy, "retry_after", return_value=1):
+            with self.assertRaises(DeadlineExceeded):
+                request(self.url + "/flaky/1", headers={"Accept": "*/*"})
+        assert _Handler.hits == {"/flaky/1": 1}
+
+    def test_nested_deadline_keeps_the_earliest(self):
+        with deadline(0):
+            with deadline(60):
+                self.assertRaises(DeadlineExceeded, request, self.url + "/index", headers={"Accept": "*/*"})
+
+
+class TestRetryPolicy(TestCase):
+    def _response(self, status: int, **headers) -> Response:
+        message = Message()
+        for name, value in headers.items():
+            message[name.replace("_", "-")] = value
+        return Response(status=status, headers=message, body="")
+
+    def test_backoff_is_jittered_and_capped(self):
+        policy = RetryPolicy(retries=10, backoff=1, max_backoff=4, deadline=None)
+        for attempt in range(1, 11):
+            delays = {policy.delay("GET", attempt, self._response(503), None, 0) for _ in range(20)}
+            assert all(0 <= delay <= min(4, 2 ** (attempt - 1)) for delay in delays)
+            assert len(delays) > 1
+        assert policy.delay("GET", 11, self._response(503), None, 0) is None
+
+    def test_retry_after(self):
+        policy = RetryPolicy(deadline=10)
+        assert policy.delay("GET", 1, self._response(429, Retry_After="7"), None, 0) == 7
+        # Waiting that long would pass the deadline
+        assert policy.delay("GET", 1, self._response(429, Retry_After="7"), None, 5) is None
+        date = self._response(503, Retry_After="Fri, 31 Dec 1999 23:59:59 GMT")
+        assert policy.delay("GET", 1, date, None, 0) == 0
+        assert (
+            RetryPolicy(respect_retry_after=False, backoff=0).delay(
+                "GET", 1, self._response(429, Retry_After="7"), None, 0
+            )
+            == 0
+        )
+
+    def test_what_is_retried(self):
+        policy = RetryPolicy()
+        assert policy.delay("GET", 1, self._response(404), None, 0) is None
+        assert policy.delay("POST", 1, self._response(503), None, 0) is None
+        assert policy.delay("GET", 1, self._response(500), ConnectionResetError(), 0) is not None
+        # A bug is not a network error
+        assert policy.delay("GET", 1, self._response(500), TypeError(), 0) is None
+
+
+class TestContentDecoding(TestCase):
+    def test_unsupported_encoding(self):
+        self.assertRaises(ValueError, ContentDecoding.decompressors, "compress")
+        assert ContentDecoding.decompressors("identity") == []
+
+    @skipIf(brotli is not None, "brotli is installed")
+    def test_br_needs_brotli(self):
+        assert ContentDecoding.br is None
+        self.assertRaises(ValueError, ContentDecoding.decompressors, "br")
+
+    def test_stacked_encodings(self):
+        body = json.dumps(INDEX_PAGE).encode()
+        data = gzip.compress(zlib.compress(body))
+        output = b""
+        decompressors = ContentDecoding.decompressors("deflate, gzip")
+        for i in range(0, len(data), 5):
+            chunk = data[i : i + 5]
+            for decompressor in decompressors:
+                chunk = decompressor.decompress(chunk)
+            output += chunk
+        chunk = b""
+        for decompressor in decompressors:
+            chunk = decompressor.decompress(chunk) + decompressor.flush()
+        assert output + chunk == body
+
+
+class TestIterJsonMembers(TestCase):
+    DOCUMENTS = [
+        {},
+        {"index": []},
+        {"index": [1, 22, -3.5e3, "a,]}", None, True, {"n": [1, {"m": {}}]}], "mark": 12345},
+        {"current": "x", "index": [{"id": "a", "d": {"content": '\u00e9 \\ " \n'}}], "count": 1.25},
+        {"index": {"not": "an array"}, "other": [1, 2]},
+    ]
+
+    def _members(self, text: str, size: int):
+        chunks = [text[i : i + size] for i in range(0, len(text), size)]
+        return list(iter_json_members(chunks, "index"))
+
+    def test_any_chunking(self):
+        for document in self.DOCUMENTS:
+            text = json.dumps(document, indent=1)
+            expected = []
+            for name, value in document.items():
+                if name == "index" and isinstance(value, list):
+                    expected.extend((name, element) for element in value)
+                else:
+                    expected.append((name, value))
+            for size in (1, 2, 3, 7, len(text)):
+                assert self._members(text, size) == expected, (document, size)
+
+    def test_invalid_documents(self):
+        for text in ['{"index": [1, 2}', '{"index": [1, 2]', "[1, 2]", "{1: 2}", ""]:
+            self.assertRaises(json.JSONDecodeError, self._members, text, 1)
+
+
+if __name__ == "__main__":
+    main()
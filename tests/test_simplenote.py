@@ -0,0 +1,219 @@
+import os
+import tempfile
+from unittest import TestCase, main, mock
+from uuid import uuid4
+
+from commands import on_changes_sent
+from lib.models import Note
+from lib.simplenote import Local, OutboxAction, load_notes
+
+
+def _reset_notes():
+    Note.mapper_id_note.clear()
+    Note.mapper_filename_note.clear()
+    Note.tree = type(Note.tree)()
+    Note.pending_ids.clear()
+
+
+class TestNoteStore(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.path = os.path.join(directory, "notes.sqlite3")
+        content_store = Note.content_store
+        self.addCleanup(setattr, Note, "content_store", content_store)
+        self.addCleanup(_reset_notes)
+        self.addCleanup(Local().close)
+        _reset_notes()
+
+    def _notes(self, number: int):
+        return [
+            Note(
+                id=uuid4().hex,
+                v=i + 1,
+                d={"content": "title %s\nbody %s" % (i, i), "tags": ["t%s" % i], "modificationDate": 100 + i},
+            )
+            for i in range(number)
+        ]
+
+    def test_cold_start_loads_metadata_only(self):
+        local = Local()
+        local.open(self.path)
+        notes = self._notes(20)
+        expected = {note.id: (note.v, note.title, note.preview, note.d.content, note.d.tags) for note in notes}
+        assert local.save_objects(notes, cursor="cursor-1")
+        local.close()
+        _reset_notes()
+
+        # Restoring the notes does not talk to the server
+        with mock.patch.object(Note, "API", new=None):
+            assert load_notes(self.path) == 20
+        assert Local().cursor == "cursor-1"
+        assert Note.tree.count == 20
+        restored = list(Note.tree.iter(reverse=True))
+        assert [note.d.modificationDate for note in restored] == list(range(119, 99, -1))
+        for note in restored:
+            v, title, preview, content, tags = expected[note.id]
+            assert note.d._content is None
+            assert (note.v, note.title, note.preview, note.d.tags) == (v, title, preview, tags)
+            assert not note.need_flush
+        note = restored[0]
+        assert note.d.content == expected[note.id][3]
+        assert note.changes() == {}
+
+    def test_upsert_replaces_the_previous_version(self):
+        store = Local().open(self.path)
+        (note,) = self._notes(1)
+        Local().save_objects([note])
+        Note(id=note.id, v=5, d={"content": "new title\nnew body", "modificationDate": 300})
+        Local().save_objects([note])
+        (summary,) = list(store.summaries())
+        assert summary[:2] == (note.id, 5)
+        assert summary[3][0] == "new title"
+        assert store.load(note.id) == "new title\nnew body"
+
+    def test_offloaded_note_keeps_its_stored_content(self):
+        store = Local().open(self.path)
+        Note.content_store = store
+        (note,) = self._notes(1)
+        assert not store.save(note.id, "not stored yet")
+        Local().save_objects([note])
+        assert note.offload(save=False)
+        Note(id=note.id, v=note.v + 1, d={"content": note.d.content, "tags": ["other"], "modificationDate": 200})
+        note.offload(save=False)
+        Local().save_objects([note])
+        assert store.load(note.id) == "title 0\nbody 0"
+        store.remove(note.id)
+        self.assertRaises(KeyError, store.load, note.id)
+
+    def test_save_appends_to_the_journal(self):
+        store = Local().open(self.path)
+        notes = self._notes(500)
+        Local().save_objects(notes)
+        store.compact()
+        assert store.journal_size() == 0
+
+        # Saving one note of a large account only appends its pages
+        note = notes[0]
+        Note(id=note.id, v=note.v + 1, d={"content": "edited\nbody", "modificationDate": 400})
+        Local().save_objects([note])
+        assert 0 < store.journal_size() < os.path.getsize(self.path) / 4
+        Local().close()
+
+        # The journal is replayed when the store is opened again
+        store = Local().open(self.path)
+        assert store.load(note.id) == "edited\nbody"
+
+    def test_large_journal_is_compacted(self):
+        self.addCleanup(setattr, Local, "journal_limit", Local.journal_limit)
+        Local.journal_limit = 1024
+        store = Local().open(self.path)
+        Local().save_objects(self._notes(50))
+        Local._compaction.join()
+        assert store.journal_size() == 0
+        assert len(list(store.summaries())) == 50
+        assert not Local().compact_if_needed()
+
+
+class TestOutbox(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.path = os.path.join(directory, "notes.sqlite3")
+        content_store = Note.content_store
+        self.addCleanup(setattr, Note, "content_store", content_store)
+        self.addCleanup(_reset_notes)
+        self.addCleanup(Local().close)
+        _reset_notes()
+        self.store = Local().open(self.path)
+        Note.content_store = self.store
+
+    def _note(self, content: str = "title\nbody") -> Note:
+        return Note(id=uuid4().hex, v=3, d={"content": content, "modificationDate": 100})
+
+    def test_changes_of_a_note_are_coalesced(self):
+        superseded = Local.superseded_changes
+        note, other = self._note(), self._note()
+        first = Local().queue_change(note)
+        Local().queue_change(other)
+        note.content = "title\nedited"
+        second = Local().queue_change(note)
+        assert second > first
+        assert Note.pending_ids == {note.id, other.id}
+        assert [change[:3] for change in Local().due_changes()] == [
+            (other.id, OutboxAction.MODIFY, first + 1),
+            (note.id, OutboxAction.MODIFY, second),
+        ]
+        # The local change is stored with the note
+        assert self.store.load(note.id) == "title\nedited"
+
+        Local().queue_change(note, OutboxAction.TRASH)
+        assert [change[1] for change in Local().due_changes() if change[0] == note.id] == [OutboxAction.TRASH]
+        # Each replaced change is an upload saved
+        assert Local.superseded_changes - superseded == 2
+
+    def test_change_sent_during_a_newer_change_stays_queued(self):
+        note = self._note()
+        revision = Local().queue_change(note)
+        note.content = "title\nnewer"
+        Local().queue_change(note)
+        assert not Local().change_sent(note.id, revision, [note])
+        assert note.id in Note.pending_ids
+        ((note_id, _, revision, _),) = Local().due_changes()
+        assert Local().change_sent(note_id, revision, [note])
+        assert Local().due_changes() == []
+        assert Note.pending_ids == set()
+
+    def test_note_saved_again_during_its_upload(self):
+        note = self._note()
+        revision = Local().queue_change(note)
+        note.content = "title\nsaved again"
+        Local().queue_change(note)
+        # The upload of the first change returns the server copy of the note
+        uploaded = Note(id=note.id, v=4, d={"content": "title\nbody", "modificationDate": 100})
+        with mock.patch("commands.flush_outbox") as flush_outbox:
+            on_changes_sent([(note.id, OutboxAction.MODIFY, revision, 0, uploaded)])
+        assert uploaded.d.content == "title\nsaved again"
+        assert note.id in Note.pending_ids
+        assert [change[0] for change in Local().due_changes()] == [note.id]
+        flush_outbox.assert_called_once_with()
+
+    def test_failed_upload_postpones_only_its_note(self):
+        failed, other = self._note(), self._note()
+        revision = Local().queue_change(failed)
+        Local().queue_change(other)
+        with mock.patch("commands.flush_outbox") as flush_outbox, mock.patch("commands._show_message"):
+            on_changes_sent([(failed.id, OutboxAction.MODIFY, revision, 0, ConnectionError("offline"))])
+        assert [change[0] for change in Local().due_changes()] == [other.id]
+        assert [change[3] for change in self.store.outbox() if change[0] == failed.id] == [1]
+        assert Note.pending_ids == {failed.id, other.id}
+        flush_outbox.assert_not_called()
+
+    def test_failed_change_backs_off(self):
+        self.addCleanup(setattr, Local, "retry_delay", Local.retry_delay)
+        Local.retry_delay = 10
+        note = self._note()
+        revision = Local().queue_change(note)
+        delays = [Local().change_failed(note.id, revision, attempts) for attempts in range(8)]
+        assert delays == [10, 20, 40, 80, 160, 320, 600, 600]
+        assert Local().due_changes() == []
+        ((_, _, _, attempts),) = self.store.outbox()
+        assert attempts == 8
+
+    def test_queued_changes_survive_a_restart(self):
+        note = self._note()
+        Local().save_objects([note])
+        note.content = "title\noffline edit"
+        Local().queue_change(note)
+        Local().close()
+        _reset_notes()
+
+        assert load_notes(self.path) == 1
+        restored = Note.mapper_id_note[note.id]
+        assert Note.pending_ids == {note.id}
+        assert restored.content == "title\noffline edit"
+        # The whole note is uploaded, the server never saw this content
+        assert restored.changes()["content"] == "title\noffline edit"
+        assert [change[0] for change in Local().due_changes()] == [note.id]
+
+
+if __name__ == "__main__":
+    main()
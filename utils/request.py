@@ -1,9 +1,17 @@
+import codecs
+import collections
+import contextlib
 from dataclasses import dataclass
 from email.message import Message
-import gzip
-import io
+import email.utils
+import functools
+import http.client
 import json
 import logging
+import random
+import re
+import threading
+import time
 import typing
 import urllib.error
 import urllib.parse
@@ -11,9 +19,33 @@ import urllib.request
 import zlib
 
 
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+
 __all__ = [
     "request",
     "Response",
+    "JSONStream",
+    "iter_json_members",
+    "Timeout",
+    "DEFAULT_TIMEOUT",
+    "DeadlineExceeded",
+    "deadline",
+    "remaining_time",
+    "RetryPolicy",
+    "DEFAULT_RETRY_POLICY",
+    "RequestMetrics",
+    "request_metrics",
+    "ConnectionPool",
+    "connection_pool",
+    "ContentDecoding",
+    "ACCEPT_ENCODING",
 ]
 __version__ = "0.0.2"
 __author__ = "redatman"
@@ -23,10 +55,104 @@ __date__ = "2024-07-19"
 logger = logging.getLogger()
 
 
+class _ZlibDecompressor:
+    """Incremental zlib decompression of a `gzip` or `deflate` body"""
+
+    def __init__(self, wbits: int, raw_fallback: bool = False):
+        self._wbits = wbits
+        self._decompressor = zlib.decompressobj(wbits)
+        # The input is kept until the zlib header is checked, to start over
+        # as raw deflate which some servers send for `deflate`
+        self._head: typing.Optional[bytes] = b"" if raw_fallback else None
+
+    def decompress(self, data: bytes) -> bytes:
+        if self._head is None:
+            return self._decompress(data)
+        self._head += data
+        try:
+            output = self._decompress(data)
+        except zlib.error:
+            self._wbits = -zlib.MAX_WBITS
+            self._decompressor = zlib.decompressobj(self._wbits)
+            data, self._head = self._head, None
+            return self._decompress(data)
+        if len(self._head) >= 2:
+            self._head = None
+        return output
+
+    def _decompress(self, data: bytes) -> bytes:
+        output = self._decompressor.decompress(data)
+        # Concatenated gzip members make up one body
+        while self._decompressor.eof and self._decompressor.unused_data:
+            data = self._decompressor.unused_data
+            self._decompressor = zlib.decompressobj(self._wbits)
+            output += self._decompressor.decompress(data)
+        return output
+
+    def flush(self) -> bytes:
+        output = self._decompressor.flush()
+        if not self._decompressor.eof:
+            raise zlib.error("Compressed body is truncated")
+        return output
+
+
+class _BrotliDecompressor:
+    """Incremental decompression of a `br` body, with either `brotli` or `brotlicffi`"""
+
+    def __init__(self):
+        self._decompressor = brotli.Decompressor()
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._decompressor.process(data)
+
+    def flush(self) -> bytes:
+        if not self._decompressor.is_finished():
+            raise ValueError("Compressed body is truncated")
+        return b""
+
+
+class ContentDecoding:
+    """Incremental decompressors of the supported `Content-Encoding`s.
+
+    Every attribute named after an encoding creates a decompressor with
+    `decompress(bytes) -> bytes` and `flush() -> bytes`. `br` needs the
+    optional `brotli` (or `brotlicffi`) package and is None without it.
+    """
+
+    gzip: typing.Optional[typing.Callable] = staticmethod(lambda: _ZlibDecompressor(16 + zlib.MAX_WBITS))
+    deflate: typing.Optional[typing.Callable] = staticmethod(lambda: _ZlibDecompressor(zlib.MAX_WBITS, True))
+    br: typing.Optional[typing.Callable] = None if brotli is None else staticmethod(_BrotliDecompressor)
+
+    ENCODINGS = ("gzip", "deflate", "br")
+
+    @classmethod
+    def supported(cls) -> typing.List[str]:
+        return [encoding for encoding in cls.ENCODINGS if getattr(cls, encoding) is not None]
+
+    @classmethod
+    def decompressors(cls, content_encoding: str) -> typing.List[typing.Any]:
+        """Decompressors in the order to apply them, for a `Content-Encoding` header"""
+        decompressors = []
+        # Listed in the order they were applied
+        for encoding in reversed(content_encoding.split(",")):
+            encoding = encoding.strip().lower()
+            if encoding in ("", "identity"):
+                continue
+            factory = getattr(cls, encoding, None) if encoding in cls.ENCODINGS else None
+            if factory is None:
+                raise ValueError("Unsupported Content-Encoding: %s" % content_encoding)
+            decompressors.append(factory())
+        return decompressors
+
+
+# Only the encodings that can be decoded are asked for
+ACCEPT_ENCODING = ", ".join(ContentDecoding.supported())
+
+
 DEFAULT_HEADERS = {
     # "Accept": "application/json",
     "Accept": "text/html,application/json,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7",
-    "Accept-Encoding": "gzip, deflate, br",
+    "Accept-Encoding": ACCEPT_ENCODING,
     "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8,zh-TW;q=0.7",
     "Content-Type": "application/json; charset=UTF-8",
     # 'Cookie': 'SESSION_COOKIE_NAME_PREFIX=redatman_',
@@ -45,25 +171,227 @@ DEFAULT_HEADERS = {
 }
 
 
-@dataclass
-class ContentDecoding:
-    default: typing.Callable = lambda response: response.read().decode(response.headers.get_content_charset("utf-8"))
-    # TODO: need validate
-    gzip: typing.Callable = lambda response: gzip.GzipFile(fileobj=io.BytesIO(response.read())).read().decode()
-    # TODO: need validate
-    deflate: typing.Callable = lambda response: zlib.decompress(response.read(), -zlib.MAX_WBITS)
+class Timeout(typing.NamedTuple):
+    """Seconds to wait for the connection, and for every read from it"""
+
+    connect: float = 10
+    read: float = 30
+
+
+DEFAULT_TIMEOUT = Timeout()
+
+
+class DeadlineExceeded(TimeoutError):
+    """The `deadline` of the thread passed before the request could be sent"""
+
+
+_deadline = threading.local()
+
+
+@contextlib.contextmanager
+def deadline(seconds: typing.Optional[float]) -> typing.Iterator[None]:
+    """Make every `request` of the current thread end within `seconds`, None means no limit.
+
+    Nested deadlines keep the earliest one.
+    """
+    previous = getattr(_deadline, "at", None)
+    at = None if seconds is None else time.monotonic() + seconds
+    if previous is not None and (at is None or previous < at):
+        at = previous
+    _deadline.at = at
+    try:
+        yield
+    finally:
+        _deadline.at = previous
+
+
+def remaining_time() -> typing.Optional[float]:
+    """Seconds left before the `deadline` of the current thread, None without one"""
+    at = getattr(_deadline, "at", None)
+    return None if at is None else at - time.monotonic()
+
+
+class ConnectionPool:
+    """Keep-alive HTTP(S) connections shared between requests, pooled per host.
+
+    Connections are borrowed for one request and handed back once the response
+    has been read completely. At most `maxsize` idle connections are kept per
+    host, and connections idle for longer than `idle_timeout` seconds are closed.
+    """
+
+    # Errors raised when the server has silently closed an idle keep-alive connection
+    STALE_CONNECTION_ERRORS = (
+        http.client.RemoteDisconnected,
+        http.client.CannotSendRequest,
+        ConnectionResetError,
+        BrokenPipeError,
+    )
+
+    # Methods safe to send again when it is unknown whether the server handled them
+    IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+
+    def __init__(self, maxsize: int = 10, idle_timeout: float = 60):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._idle: typing.Dict[
+            typing.Tuple[str, str, int], typing.Deque[typing.Tuple[http.client.HTTPConnection, float]]
+        ] = {}
+        self._in_use = 0
+        self._hits = 0
+        self._misses = 0
 
     @staticmethod
-    def br(response):
-        decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
-        return decompressor.decompress(response.read()) + decompressor.flush()
+    def _key(url: str) -> typing.Tuple[str, str, int]:
+        parsed = urllib.parse.urlsplit(url)
+        scheme = parsed.scheme.lower()
+        port = parsed.port or (443 if scheme == "https" else 80)
+        return scheme, parsed.hostname or "", port
+
+    @staticmethod
+    def _connect(key: typing.Tuple[str, str, int]) -> http.client.HTTPConnection:
+        scheme, host, port = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port)
+        return http.client.HTTPConnection(host, port)
+
+    @staticmethod
+    def _set_timeout(connection: http.client.HTTPConnection, timeout: Timeout):
+        """Connect with the connect timeout, then bound every read of this request by the read timeout"""
+        if connection.sock is None:
+            connection.timeout = timeout.connect
+            connection.connect()
+        sock = connection.sock
+        assert sock is not None, "connection is not connected"
+        sock.settimeout(timeout.read)
+
+    def _evict(self, now: float):
+        """Close idle connections older than `idle_timeout`, the caller holds the lock"""
+        for idle in self._idle.values():
+            while idle and now - idle[0][1] > self.idle_timeout:
+                connection, _ = idle.popleft()
+                connection.close()
+
+    def _acquire(self, key: typing.Tuple[str, str, int]) -> typing.Tuple[http.client.HTTPConnection, bool]:
+        with self._lock:
+            self._evict(time.monotonic())
+            idle = self._idle.get(key)
+            self._in_use += 1
+            if idle:
+                self._hits += 1
+                # The most recently used connection is the most likely to be still alive
+                return idle.pop()[0], True
+            self._misses += 1
+        return self._connect(key), False
+
+    def _release(self, key: typing.Tuple[str, str, int], connection: http.client.HTTPConnection):
+        with self._lock:
+            self._in_use -= 1
+            now = time.monotonic()
+            self._evict(now)
+            idle = self._idle.setdefault(key, collections.deque())
+            if len(idle) < self.maxsize:
+                idle.append((connection, now))
+                return
+        connection.close()
+
+    def _discard(self, connection: http.client.HTTPConnection):
+        with self._lock:
+            self._in_use -= 1
+        connection.close()
+
+    @contextlib.contextmanager
+    def urlopen(
+        self,
+        method: str,
+        url: str,
+        body: typing.Optional[bytes] = None,
+        headers: typing.Optional[typing.Dict[str, str]] = None,
+        timeout: Timeout = DEFAULT_TIMEOUT,
+    ) -> typing.Iterator[http.client.HTTPResponse]:
+        """Send a request over a pooled connection and yield the response.
+
+        Unlike `urllib.request.urlopen` redirects are not followed and error
+        statuses are returned instead of raised.
+        """
+        key = self._key(url)
+        parsed = urllib.parse.urlsplit(url)
+        path = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+        headers = headers or {}
+
+        connection, reused = self._acquire(key)
+        try:
+            sent = False
+            try:
+                self._set_timeout(connection, timeout)
+                connection.request(method, path, body=body, headers=headers)
+                sent = True
+                response = connection.getresponse()
+            except self.STALE_CONNECTION_ERRORS:
+                # Once sent, the server may have handled the request before closing the
+                # connection, so only an idempotent request is sent again
+                if not reused or (sent and method.upper() not in self.IDEMPOTENT_METHODS):
+                    raise
+                # Retry once on a fresh connection
+                connection.close()
+                with self._lock:
+                    self._misses += 1
+                connection = self._connect(key)
+                self._set_timeout(connection, timeout)
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+            yield response
+        except BaseException:
+            self._discard(connection)
+            raise
+        # Only a fully read response leaves the connection ready for the next request
+        if response.isclosed() and not response.will_close:
+            self._release(key, connection)
+        else:
+            self._discard(connection)
+
+    def stats(self) -> typing.Dict[str, int]:
+        """Counters to verify connection reuse: pool hits, misses and open sockets"""
+        with self._lock:
+            idle = sum(len(connections) for connections in self._idle.values())
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "idle": idle,
+                "in_use": self._in_use,
+                "open": idle + self._in_use,
+            }
 
+    def clear(self):
+        """Close all idle connections"""
+        with self._lock:
+            for idle in self._idle.values():
+                while idle:
+                    idle.pop()[0].close()
 
-class Response(typing.NamedTuple):
+
+connection_pool = ConnectionPool()
+
+
+class _ResponseFields(typing.NamedTuple):
     status: int
     headers: Message
     body: str
     error_count: int = 0
+    # Number of times the request was sent, see `RetryPolicy`
+    attempts: int = 1
+
+
+class Response(_ResponseFields):
+    """The body is parsed once, on first use, or while it downloads with a `JSONStream`"""
+
+    def _replace(self, **kwargs) -> "Response":
+        response = super()._replace(**kwargs)
+        # Keep the parsed body
+        response.__dict__.update(self.__dict__)
+        return response
 
     def json(self) -> typing.Union[typing.Dict[str, str], typing.List[typing.Dict[str, str]]]:
         """
@@ -72,15 +400,340 @@ class Response(typing.NamedTuple):
         Returns:
             Pythonic representation of the JSON object
         """
+        return self.data
+
+    @functools.cached_property
+    def data(self):
         try:
             output = json.loads(self.body)
         except json.JSONDecodeError:
             output = {}
         return output
 
-    @property
-    def data(self):
-        return self.json()
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_DECODER = json.JSONDecoder()
+
+
+class _JSONReader:
+    """Reads JSON values one by one from text chunks, keeping only the unread text"""
+
+    def __init__(self, chunks: typing.Iterable[str]):
+        self._chunks = iter(chunks)
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    def _more(self) -> bool:
+        if self._eof:
+            return False
+        for chunk in self._chunks:
+            if chunk:
+                self._buffer = self._buffer[self._pos :] + chunk
+                self._pos = 0
+                return True
+        self._eof = True
+        return False
+
+    def peek(self) -> str:
+        """The next non-whitespace character, an empty string at the end"""
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._more():
+                return ""
+
+    def expect(self, chars: str) -> str:
+        char = self.peek()
+        if not char or char not in chars:
+            raise json.JSONDecodeError("Expecting one of %r" % chars, self._buffer, self._pos)
+        self._pos += 1
+        return char
+
+    def value(self) -> typing.Any:
+        self.peek()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._more():
+                    raise
+                continue
+            # A number may go on in the next chunk, "1" of "1.5e3" or "-3." of "-3.5" decode already
+            partial = end == len(self._buffer) or (
+                isinstance(value, (int, float)) and self._buffer[end] in "+-.eE0123456789"
+            )
+            if partial and self._more():
+                continue
+            self._pos = end
+            return value
+
+
+def iter_json_members(
+    chunks: typing.Iterable[str], array_key: typing.Optional[str] = None
+) -> typing.Iterator[typing.Tuple[str, typing.Any]]:
+    """
+    Parse the JSON object in `chunks` incrementally, yielding its (name, value) members.
+
+    The elements of the `array_key` array are yielded one by one, as (array_key, element),
+    as soon as each of them is complete; the array itself is never built.
+    """
+    reader = _JSONReader(chunks)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+    while True:
+        name = reader.value()
+        if not isinstance(name, str):
+            raise json.JSONDecodeError("Expecting property name", str(name), 0)
+        reader.expect(":")
+        if name == array_key and reader.peek() == "[":
+            reader.expect("[")
+            if reader.peek() == "]":
+                reader.expect("]")
+            else:
+                while True:
+                    yield name, reader.value()
+                    if reader.expect(",]") == "]":
+                        break
+        else:
+            yield name, reader.value()
+        if reader.expect(",}") == "}":
+            return
+
+
+@dataclass
+class JSONStream:
+    """Parse a JSON object body while it is downloaded, see `iter_json_members`.
+
+    `item` is applied to every element of the `key` array as soon as it is parsed,
+    the elements it returns None for are dropped.
+    """
+
+    key: str
+    item: typing.Callable[[typing.Any], typing.Any] = lambda value: value
+
+    def parse(self, chunks: typing.Iterable[str]) -> typing.Dict[str, typing.Any]:
+        result: typing.Dict[str, typing.Any] = {self.key: []}
+        for name, value in iter_json_members(chunks, self.key):
+            if name != self.key:
+                result[name] = value
+                continue
+            value = self.item(value)
+            if value is not None:
+                result[name].append(value)
+        return result
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """When `request` sends a failed request again, and how long it waits before.
+
+    Only `methods` are retried, by default the idempotent ones: a POST that failed
+    on the way back may have been applied already. Connection errors and the
+    `statuses` are retried at most `retries` times, after a `Retry-After` delay
+    when the server sends one, otherwise after a random delay of up to
+    `backoff * 2 ** retry` seconds ("full jitter", so clients failing together
+    do not retry together). No retry starts past `deadline` seconds from the
+    first attempt.
+    """
+
+    retries: int = 3
+    methods: typing.FrozenSet[str] = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+    statuses: typing.FrozenSet[int] = frozenset({429, 500, 502, 503, 504})
+    backoff: float = 0.5
+    max_backoff: float = 30
+    deadline: typing.Optional[float] = 60
+    respect_retry_after: bool = True
+
+    # Errors of a request that did not get a response, worth sending again
+    RETRYABLE_ERRORS: typing.ClassVar[typing.Tuple[typing.Type[BaseException], ...]] = (
+        OSError,
+        http.client.HTTPException,
+    )
+
+    @staticmethod
+    def retry_after(response: "Response") -> typing.Optional[float]:
+        """Seconds to wait as asked by the `Retry-After` header, None without a valid one"""
+        value = response.headers.get("Retry-After") if response.headers else None
+        if not value:
+            return None
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if date is None:
+            return None
+        return max(0.0, date.timestamp() - time.time())
+
+    def delay(
+        self, method: str, attempt: int, response: "Response", error: typing.Optional[BaseException], elapsed: float
+    ) -> typing.Optional[float]:
+        """Seconds to wait before the next attempt, None when the request is not retried"""
+        if attempt > self.retries or method not in self.methods:
+            return None
+        if error is not None:
+            if not isinstance(error, self.RETRYABLE_ERRORS):
+                return None
+        elif response.status not in self.statuses:
+            return None
+        delay = self.retry_after(response) if self.respect_retry_after else None
+        if delay is None:
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+        if self.deadline is not None and elapsed + delay > self.deadline:
+            return None
+        return delay
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+class RequestMetrics:
+    """Counts the attempts of every `request` call, to see how much the retries cost"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # attempts of a call -> number of calls
+        self._attempts_per_call: typing.Counter[int] = collections.Counter()
+        self._failed = 0
+
+    def record(self, attempts: int, failed: bool):
+        with self._lock:
+            self._attempts_per_call[attempts] += 1
+            self._failed += failed
+
+    def stats(self) -> typing.Dict[str, int]:
+        """Calls, attempts, retries and the calls that failed after all their attempts"""
+        with self._lock:
+            calls = sum(self._attempts_per_call.values())
+            attempts = sum(attempts * calls for attempts, calls in self._attempts_per_call.items())
+            return {
+                "calls": calls,
+                "attempts": attempts,
+                "retries": attempts - calls,
+                "failed": self._failed,
+            }
+
+    def attempts_per_call(self) -> typing.Dict[int, int]:
+        with self._lock:
+            return dict(self._attempts_per_call)
+
+    def clear(self):
+        with self._lock:
+            self._attempts_per_call.clear()
+            self._failed = 0
+
+
+request_metrics = RequestMetrics()
+
+
+def _use_connection_pool(url: str) -> bool:
+    """Requests that need a proxy go through urllib, which knows how to talk to them"""
+    parsed = urllib.parse.urlsplit(url)
+    proxies = urllib.request.getproxies()
+    if parsed.scheme.lower() not in proxies:
+        return True
+    return bool(urllib.request.proxy_bypass(parsed.hostname or ""))
+
+
+# Bytes read from the socket at a time
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def _iter_bytes(httpresponse) -> typing.Iterator[bytes]:
+    """The body as read from the socket, decompressed chunk by chunk"""
+    content_encoding = httpresponse.headers.get("Content-Encoding", "")
+    logger.debug(content_encoding)
+    decompressors = ContentDecoding.decompressors(content_encoding)
+    while True:
+        chunk = httpresponse.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            break
+        for decompressor in decompressors:
+            chunk = decompressor.decompress(chunk)
+        if chunk:
+            yield chunk
+    chunk = b""
+    for decompressor in decompressors:
+        chunk = decompressor.decompress(chunk) + decompressor.flush()
+    if chunk:
+        yield chunk
+
+
+def _iter_text(httpresponse) -> typing.Iterator[str]:
+    decoder = codecs.getincrementaldecoder(httpresponse.headers.get_content_charset("utf-8"))()
+    for chunk in _iter_bytes(httpresponse):
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
+
+
+def _read_response(httpresponse, error_count: int = 0, stream: typing.Optional[JSONStream] = None) -> Response:
+    if stream is not None and httpresponse.status == 200:
+        # The body is parsed while it is read, it is not kept as text
+        data = stream.parse(_iter_text(httpresponse))
+        response = Response(headers=httpresponse.headers, status=httpresponse.status, body="", error_count=error_count)
+        response.__dict__["data"] = data
+        return response
+    body = "".join(_iter_text(httpresponse))
+    if httpresponse.status >= 400:
+        error_count += 1
+    return Response(
+        headers=httpresponse.headers,
+        status=httpresponse.status,
+        body=body,
+        error_count=error_count,
+    )
+
+
+def _send(
+    method: str,
+    url: str,
+    request_data: typing.Optional[bytes],
+    headers: typing.Dict,
+    error_count: int,
+    timeout: Timeout,
+    stream: typing.Optional[JSONStream] = None,
+) -> typing.Tuple[Response, typing.Optional[Exception]]:
+    """Send the request once, a request that got no response is turned into a 500 `Response` with its error"""
+    try:
+        if _use_connection_pool(url):
+            with connection_pool.urlopen(
+                method, url, body=request_data, headers=headers, timeout=timeout
+            ) as httpresponse:
+                return _read_response(httpresponse, error_count, stream), None
+        else:
+            httprequest = urllib.request.Request(url, data=request_data, headers=headers, method=method)
+            # urllib has a single timeout for connecting and reading
+            with urllib.request.urlopen(httprequest, timeout=max(timeout)) as httpresponse:
+                return _read_response(httpresponse, error_count, stream), None
+    except Exception as err:
+        logger.error((method, url, headers))
+        logger.exception(err)
+        _body = str(err)
+        _headers = Message()
+        _status = 500
+        error: typing.Optional[Exception] = err
+        error_count += 1
+        if isinstance(err, urllib.error.HTTPError):
+            # The server did respond, with an error status
+            _body = str(err.reason)
+            _headers = err.headers
+            _status = err.code
+            error = None
+        elif isinstance(err, urllib.error.URLError):
+            _body = str(err.reason)
+
+        response = Response(
+            body=_body,
+            headers=_headers,
+            status=_status,
+            error_count=error_count,
+        )
+        return response, error
 
 
 def request(
@@ -91,7 +744,19 @@ def request(
     method: str = "GET",
     data_as_json: bool = True,
     error_count: int = 0,
+    retry: typing.Optional[RetryPolicy] = None,
+    timeout: Timeout = DEFAULT_TIMEOUT,
+    stream: typing.Optional[JSONStream] = None,
 ) -> Response:
+    """Send the request, retried according to `retry`.
+
+    With a `stream` a successful JSON body is parsed while it is read, see `JSONStream`.
+
+    Every attempt is bounded by `timeout`, and all of them by the `deadline`
+    of the thread if there is one: `DeadlineExceeded` is raised instead of
+    starting an attempt after the deadline, when the deadline cut an attempt
+    short, or when it leaves no time to retry.
+    """
     if not url.casefold().startswith("http"):
         raise urllib.error.URLError("Incorrect and possibly insecure protocol in url")
     method = method.upper()
@@ -101,6 +766,7 @@ def request(
     params = params or {}
     # headers = dict(DEFAULT_HEADERS, **headers)
     headers = headers or DEFAULT_HEADERS
+    headers.setdefault("Accept-Encoding", ACCEPT_ENCODING)
 
     if method == "GET":
         params = dict(params, **data)
@@ -115,40 +781,32 @@ def request(
             headers["Content-Type"] = "application/json; charset=UTF-8"
         else:
             request_data = urllib.parse.urlencode(data).encode()
+            headers.setdefault("Content-Type", "application/x-www-form-urlencoded")
 
     logger.debug(f"url: {url}, method: {method}, headers: {headers}, data: {data}")
-    httprequest = urllib.request.Request(url, data=request_data, headers=headers, method=method)
 
-    try:
-        with urllib.request.urlopen(httprequest) as httpresponse:
-            # content_encoding = httpresponse.getheader("Content-Encoding", "default")
-            content_encoding = httpresponse.info().get("content-encoding", "default")
-            logger.debug(content_encoding)
-            body = getattr(ContentDecoding, content_encoding, ContentDecoding.default)(httpresponse)
-            response = Response(
-                headers=httpresponse.headers,
-                status=httpresponse.status,
-                body=body,
-            )
-    except Exception as err:
-        logger.error((method, url, headers, data))
-        logger.exception(err)
-        _body = str(err)
-        _headers = Message()
-        _status = 500
-        error_count += 1
-        if isinstance(err, urllib.error.HTTPError):
-            _body = str(err.reason)
-            _headers = err.headers
-            _status = err.code
-        elif isinstance(err, urllib.error.URLError):
-            _body = str(err.reason)
-
-        response = Response(
-            body=_body,
-            headers=_headers,
-            status=_status,
-            error_count=error_count,
-        )
+    retry = DEFAULT_RETRY_POLICY if retry is None else retry
+    start = time.monotonic()
+    attempt = 0
+    while True:
+        left = remaining_time()
+        if left is not None:
+            if left <= 0:
+                raise DeadlineExceeded("%s %s: deadline exceeded" % (method, url))
+            timeout = Timeout(min(timeout.connect, left), min(timeout.read, left))
+        attempt += 1
+        response, error = _send(method, url, request_data, headers, error_count, timeout, stream)
+        error_count = response.error_count
+        delay = retry.delay(method, attempt, response, error, time.monotonic() - start)
+        left = remaining_time()
+        if left is not None and ((error is not None and left <= 0) or (delay is not None and delay >= left)):
+            # The attempt was cut short by the deadline, or there is no time left for another one
+            request_metrics.record(attempt, failed=True)
+            raise DeadlineExceeded("%s %s: deadline exceeded after %s attempts" % (method, url, attempt)) from error
+        if delay is None:
+            break
+        logger.warning("Retrying %s %s in %.2fs, attempt %s got %s" % (method, url, delay, attempt, response.status))
+        time.sleep(delay)
 
-    return response
+    request_metrics.record(attempt, failed=response.status >= 400)
+    return response._replace(attempts=attempt)
@@ -0,0 +1,53 @@
+"""
+Ordered key -> value indexes interchangeable behind `SortedIndex`
+"""
+
+from typing import Any, Callable, Dict, Iterable, Iterator, Protocol, Tuple
+
+from .redblacktree import rbtree
+from .sortedarray import sortedarray
+
+
+__all__ = [
+    "SortedIndex",
+    "INDEX_TYPES",
+    "new_index",
+]
+
+
+class SortedIndex(Protocol):
+    """The operations `Note.tree` relies on, implemented by `rbtree` and `sortedarray`"""
+
+    count: int
+
+    def insert(self, key: Any, value: Any = None) -> None: ...
+
+    def remove(self, key: Any) -> None: ...
+
+    def find(self, key: Any) -> Any: ...
+
+    def load_sorted(self, items: Iterable[Tuple[Any, Any]]) -> None: ...
+
+    def iter(self, value: bool = True, reverse: bool = False) -> Iterator[Any]: ...
+
+    def range(self, lo: Any = None, hi: Any = None, reverse: bool = False) -> Iterator[Tuple[Any, Any]]: ...
+
+    def __getitem__(self, key: Any) -> Any: ...
+
+    def __contains__(self, key: Any) -> bool: ...
+
+    def __len__(self) -> int: ...
+
+
+INDEX_TYPES: Dict[str, Callable[[], SortedIndex]] = {
+    "rbtree": rbtree,
+    "sortedarray": sortedarray,
+}
+
+
+def new_index(name: str) -> SortedIndex:
+    """An empty index of the type named in the `note_index` setting"""
+    try:
+        return INDEX_TYPES[name]()
+    except KeyError:
+        raise ValueError("Unknown index type %r, expected one of %s" % (name, ", ".join(INDEX_TYPES))) from None
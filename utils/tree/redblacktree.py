@@ -7,30 +7,32 @@ def empty_generator():
 
 
 def bstslice(tree, left, right):
-    def inorder(node):
-        if node.left and left < node.key:
-            for kv in inorder(node.left):
-                yield kv
+    """(key, value) items with left <= key <= right, a None bound is left open"""
+    if left is not None and right is not None and left > right:
+        return empty_generator()
+    return tree._range_items(left, right, True, False)
 
-        if node.key >= left and node.key <= right:
-            yield (node.key, node.val)
-
-        if node.right and right > node.key:
-            for kv in inorder(node.right):
-                yield kv
 
-    if left == None or right == None or left > right:
-        return []
+def _successor(node):
+    if node.right:
+        node = node.right
+        while node.left:
+            node = node.left
+        return node
+    while node.parent and node.parent.right is node:
+        node = node.parent
+    return node.parent
 
-    curr = tree._find_node_margin(tree.root, left)
-    while curr:
-        if curr.key >= left and curr.key <= right:
-            yield (curr.key, curr.val)
-            if curr.right:
-                for kv in inorder(curr.right):
-                    yield kv
 
-        curr = curr.parent
+def _predecessor(node):
+    if node.left:
+        node = node.left
+        while node.right:
+            node = node.right
+        return node
+    while node.parent and node.parent.left is node:
+        node = node.parent
+    return node.parent
 
 
 class bstnode:
@@ -47,24 +49,40 @@ class bstnode:
         yield from self.__iter__()
 
     def __iter__(self):
-        if self.left:
-            for node in self.left.__iter__():
-                yield node
-
-        yield self
-
-        if self.right:
-            for node in self.right.__iter__():
-                yield node
+        """In-order nodes of the subtree, walked through the parent pointers without recursion"""
+        node = self
+        while node.left:
+            node = node.left
+        while node:
+            yield node
+            if node.right:
+                node = node.right
+                while node.left:
+                    node = node.left
+                continue
+            while node is not self and node.parent.right is node:
+                node = node.parent
+            if node is self:
+                return
+            node = node.parent
 
     def __reverse__(self):
-        if self.right:
-            for node in self.right.__reverse__():
-                yield node
-        yield self
-        if self.left:
-            for node in self.left.__reverse__():
-                yield node
+        """Mirror of `__iter__`, from the largest key to the smallest"""
+        node = self
+        while node.right:
+            node = node.right
+        while node:
+            yield node
+            if node.left:
+                node = node.left
+                while node.right:
+                    node = node.right
+                continue
+            while node is not self and node.parent.left is node:
+                node = node.parent
+            if node is self:
+                return
+            node = node.parent
 
     def __init__(self, key, value):
         self.key = key
@@ -122,10 +140,6 @@ class bst:
         self.count = 0
         self.root = None
 
-        # These two are currently used for slicing
-        self.min_so_far = None
-        self.max_so_far = None
-
     def insert(self, key, value=None):
         raise Exception("Not implemented")
 
@@ -149,6 +163,48 @@ class bst:
         for node in generator:
             yield node.val if value else node
 
+    def range(self, lo=None, hi=None, reverse=False):
+        """
+        Lazily yields the (key, value) items with lo <= key < hi, a None bound is left open.
+
+        Only the nodes in the range are visited, after one O(log n) descent to its first node.
+        """
+        if lo is not None and hi is not None and not lo < hi:
+            return empty_generator()
+        return self._range_items(lo, hi, False, reverse)
+
+    def _range_items(self, lo, hi, hi_inclusive, reverse):
+        if reverse:
+            node = self._last_below(hi, hi_inclusive)
+            while node and (lo is None or node.key >= lo):
+                yield (node.key, node.val)
+                node = _predecessor(node)
+            return
+        node = self._first_at_least(lo)
+        while node and (hi is None or node.key < hi or hi_inclusive and node.key == hi):
+            yield (node.key, node.val)
+            node = _successor(node)
+
+    def _first_at_least(self, lo):
+        """The node with the smallest key >= lo, or the smallest one for None"""
+        node, found = self.root, None
+        while node:
+            if lo is None or node.key >= lo:
+                found, node = node, node.left
+            else:
+                node = node.right
+        return found
+
+    def _last_below(self, hi, inclusive=False):
+        """The node with the largest key < hi (or <= hi), or the largest one for None"""
+        node, found = self.root, None
+        while node:
+            if hi is None or node.key < hi or inclusive and node.key == hi:
+                found, node = node, node.right
+            else:
+                node = node.left
+        return found
+
     def find(self, key, node=False):
         if not self.root:
             return
@@ -163,10 +219,7 @@ class bst:
 
     def __getitem__(self, key):
         if type(key) is slice:
-            left = key.start if key.start != None else self.min_so_far
-            right = key.stop if key.stop != None else self.max_so_far
-
-            return list(bstslice(self, left, right))
+            return list(bstslice(self, key.start, key.stop))
 
         else:
             node = self._find_node(self.root, key) if self.root else None
@@ -201,7 +254,7 @@ class bst:
         return equal(self.root, other.root)
 
     def __len__(self):
-        return self.root.num_nodes() if self.root else 0
+        return self.count
 
     def depth(self):
         """Returns the depth of the tree"""
@@ -214,33 +267,20 @@ class bst:
         return self.root.inorder() if self.root else empty_generator()
 
     def _find_node(self, node, key):
-        if node.key == key:
-            return node
-        elif key < node.key:
-            return self._find_node(node.left, key) if node.left else None
-        return self._find_node(node.right, key) if node.right else None
-
-    def _find_node_margin(self, node, key):
-        if node.key == key:
-            return node
-
-        if key < node.key:
-            if node.left:
-                return self._find_node_margin(node.left, key)
-            return node
-
-        if node.right:
-            return self._find_node_margin(node.right, key)
-        return node
+        while node:
+            if key == node.key:
+                return node
+            node = node.left if key < node.key else node.right
+        return None
 
     def _find_max(self, node):
-        if node.right:
-            return self._find_max(node.right)
+        while node.right:
+            node = node.right
         return node
 
     def _find_min(self, node):
-        if node.left:
-            return self._find_min(node.left)
+        while node.left:
+            node = node.left
         return node
 
     def _insert_node(self, start, to_insert):
@@ -250,30 +290,26 @@ class bst:
         """
 
         def insert_internal(current_node):
-            if to_insert.key < current_node.key:
-                if current_node.left:
-                    return insert_internal(current_node.left)
-
-                current_node.left = to_insert
-                to_insert.parent = current_node
-                self.count += 1
-                return True
-
-            elif to_insert.key > current_node.key:
-                if current_node.right:
-                    return insert_internal(current_node.right)
+            key = to_insert.key
+            while True:
+                if key < current_node.key:
+                    if current_node.left:
+                        current_node = current_node.left
+                        continue
+                    current_node.left = to_insert
+                elif key > current_node.key:
+                    if current_node.right:
+                        current_node = current_node.right
+                        continue
+                    current_node.right = to_insert
+                else:
+                    current_node.val = to_insert.val
+                    return False
 
-                current_node.right = to_insert
                 to_insert.parent = current_node
                 self.count += 1
                 return True
 
-            current_node.val = to_insert.val
-            return False
-
-        self.min_so_far = min(self.min_so_far, to_insert.key) if self.min_so_far != None else to_insert.key
-        self.max_so_far = max(self.max_so_far, to_insert.key) if self.max_so_far != None else to_insert.key
-
         if not self.root:
             self.root = to_insert
             self.count += 1
@@ -372,6 +408,7 @@ class rbnode(bstnode):
 class rbtree(bst):
     left = 0
     right = 1
+    node_type = rbnode
 
     def __init__(self, initializer=None):
         super().__init__()
@@ -403,6 +440,45 @@ class rbtree(bst):
                     else:
                         self.insert(key=k)
 
+    def _bulk_node(self, key, value, color, size):
+        return self.node_type(key, value, color)
+
+    def load_sorted(self, items):
+        """Replace the contents with `(key, value)` items sorted by key, in O(n).
+
+        The new tree is built aside and swapped in at once, readers never see a
+        partially loaded tree. Of equal keys the last value is kept, like `insert`.
+        """
+        pairs = []
+        for key, value in items:
+            if pairs and not pairs[-1][0] <= key:
+                raise ValueError("load_sorted needs items sorted by key: %s after %s" % (key, pairs[-1][0]))
+            if pairs and pairs[-1][0] == key:
+                pairs[-1] = (key, value)
+            else:
+                pairs.append((key, value))
+
+        # Splitting at the middle fills every level but the last one, whose
+        # nodes are colored red so that all paths have the same black height
+        red_depth = (len(pairs) + 1).bit_length() - 1
+
+        def build(lo, hi, depth):
+            if lo > hi:
+                return None
+            mid = (lo + hi) // 2
+            key, value = pairs[mid]
+            node = self._bulk_node(key, value, depth != red_depth, hi - lo + 1)
+            node.left = build(lo, mid - 1, depth + 1)
+            node.right = build(mid + 1, hi, depth + 1)
+            if node.left:
+                node.left.parent = node
+            if node.right:
+                node.right.parent = node
+            return node
+
+        root = build(0, len(pairs) - 1, 0)
+        self.root, self.count = root, len(pairs)
+
     def _check_valid(self):
         def enum_black_heights(node, prev_colored=True, black_height=0):
             if not node.colored and not prev_colored:
@@ -586,7 +662,7 @@ class rbtree(bst):
             self.fixups[dir][3](node, parent, sibling)
 
     def insert(self, key, value=None):
-        node = rbnode(key, value, False if self.root else True)
+        node = self.node_type(key, value, False if self.root else True)
         if self._insert_node(self.root, node):
             self._rebalance(node)
 
@@ -611,6 +687,9 @@ class rbtree(bst):
             node.val, leaf.val = leaf.val, node.val
             node = leaf
 
+        self._remove_leaf(leaf)
+
+    def _remove_leaf(self, leaf):
         # Fixup rbtree
         self._remove_fixup(leaf)
 
@@ -627,6 +706,115 @@ class rbtree(bst):
         self.count -= 1
 
 
+class osrbnode(rbnode):
+    size: int
+
+    def __init__(self, key, value, color):
+        super().__init__(key, value, color)
+        # Number of nodes in the subtree rooted at this node
+        self.size = 1
+
+
+def _size(node):
+    return node.size if node else 0
+
+
+class osrbtree(rbtree):
+    """Order-statistic red-black tree.
+
+    Every node keeps the size of its subtree, so the node at an in-order
+    position and the position of a key are found in O(log n).
+    """
+
+    node_type = osrbnode
+
+    def insert(self, key, value=None):
+        node = self.node_type(key, value, False if self.root else True)
+        if self._insert_node(self.root, node):
+            parent = node.parent
+            while parent:
+                parent.size += 1
+                parent = parent.parent
+            self._rebalance(node)
+
+    def _bulk_node(self, key, value, color, size):
+        node = self.node_type(key, value, color)
+        node.size = size
+        return node
+
+    def _remove_leaf(self, leaf):
+        # The leaf no longer counts while the tree is rebalanced around it
+        leaf.size = 0
+        parent = leaf.parent
+        while parent:
+            parent.size -= 1
+            parent = parent.parent
+        super()._remove_leaf(leaf)
+
+    def _rotate_right(self, y):
+        super()._rotate_right(y)
+        x = y.parent
+        y.size = 1 + _size(y.left) + _size(y.right)
+        x.size = 1 + _size(x.left) + y.size
+
+    def _rotate_left(self, x):
+        super()._rotate_left(x)
+        y = x.parent
+        x.size = 1 + _size(x.left) + _size(x.right)
+        y.size = 1 + x.size + _size(y.right)
+
+    def _select_node(self, k):
+        if k < 0:
+            k += self.count
+        if not 0 <= k < self.count:
+            raise IndexError("osrbtree index out of range: %s" % k)
+        node = self.root
+        while True:
+            left_size = _size(node.left)
+            if k < left_size:
+                node = node.left
+            elif k > left_size:
+                k -= left_size + 1
+                node = node.right
+            else:
+                return node
+
+    def select(self, k, node=False):
+        """The value (or node) of the k-th smallest key, negative k counts from the largest"""
+        _node = self._select_node(k)
+        return _node if node else _node.val
+
+    def rank(self, key):
+        """Number of keys smaller than `key`, whether or not `key` is in the tree"""
+        rank = 0
+        node = self.root
+        while node:
+            if key <= node.key:
+                node = node.left
+            else:
+                rank += _size(node.left) + 1
+                node = node.right
+        return rank
+
+    def window(self, offset, limit, value=True, reverse=False):
+        """Up to `limit` values (or nodes) starting at the in-order position `offset`"""
+        if offset < 0 or limit <= 0 or offset >= self.count:
+            return []
+        node = self._select_node(self.count - 1 - offset if reverse else offset)
+        result = []
+        while node and len(result) < limit:
+            result.append(node.val if value else node)
+            node = _predecessor(node) if reverse else _successor(node)
+        return result
+
+    def _check_sizes(self):
+        for node in self:
+            if node.size != 1 + _size(node.left) + _size(node.right):
+                raise Exception("Invalid OSRBTree: wrong subtree size at %s" % node.key)
+        if _size(self.root) != self.count:
+            raise Exception("Invalid OSRBTree: root size differs from count")
+
+
 def rbtree_from_array(arr):
     tree = rbtree()
     size_arr = len(arr)
@@ -654,6 +842,7 @@ def rbtree_from_array(arr):
             node.parent = parent
         else:
             tree.root = node
+        tree.count += 1
 
         idx_left = idx * 2 + 1
         idx_right = idx * 2 + 2
@@ -816,6 +1005,117 @@ def test_len():
         assert len(tree) == i, "Invalid tree length after removal"
 
 
+def test_deep_traversals():
+    nums = list(range(5000))
+    shuffle(nums)
+    tree = rbtree()
+    for num in nums:
+        tree.insert(num, -num)
+    assert [node.key for node in tree] == list(range(5000)), "Invalid iterative inorder traversal"
+    assert list(tree.iter(reverse=True)) == [-num for num in range(4999, -1, -1)], "Invalid reverse traversal"
+
+    # Traversing a subtree stops at its root
+    subtree = tree.root.left
+    keys = [node.key for node in subtree]
+    assert keys == sorted(keys) and keys[-1] < tree.root.key, "Subtree traversal left the subtree"
+    assert [node.key for node in subtree.__reverse__()] == keys[::-1], "Invalid subtree reverse traversal"
+    assert len(tree) == tree.root.num_nodes(), "Tree __len__ differs from the number of nodes"
+
+
+def test_order_statistics():
+    tree = osrbtree()
+    keys = []
+    for num in [randint(0, 500) for i in range(600)]:
+        tree.insert(num, -num)
+        if num not in keys:
+            keys.append(num)
+    keys.sort()
+
+    for num in keys[::3]:
+        tree.remove(num)
+        keys.remove(num)
+        try:
+            tree._check_valid()
+            tree._check_sizes()
+        except Exception as e:
+            raise AssertionError(e)
+
+    assert len(tree) == len(keys), "Order-statistic tree length is wrong"
+    for k, key in enumerate(keys):
+        assert tree.select(k) == -key, f"select({k}) is not the {k}-th smallest key"
+        assert tree.rank(key) == k, f"rank({key}) is not {k}"
+    assert tree.select(-1) == -keys[-1], "select(-1) is not the largest key"
+    assert tree.rank(-1) == 0 and tree.rank(501) == len(keys), "rank of keys outside the tree is wrong"
+
+    for i in range(20):
+        offset, limit = randint(0, len(keys)), randint(0, 50)
+        assert tree.window(offset, limit) == [-key for key in keys[offset : offset + limit]], "Invalid window"
+        expected = [-key for key in keys[::-1][offset : offset + limit]]
+        assert tree.window(offset, limit, reverse=True) == expected, "Invalid reverse window"
+
+    try:
+        tree.select(len(keys))
+    except IndexError:
+        pass
+    else:
+        raise AssertionError("select out of range does not raise IndexError")
+
+
+def test_load_sorted():
+    for size in list(range(40)) + [255, 256, 1000]:
+        for tree_type in (rbtree, osrbtree):
+            tree = tree_type([(-1, None)])
+            items = [(i, i + 1) for i in range(size)]
+            tree.load_sorted(items)
+            try:
+                tree._check_valid()
+                if tree_type is osrbtree:
+                    tree._check_sizes()
+            except Exception as e:
+                raise AssertionError(e)
+            assert tree[:] == items and len(tree) == size, f"load_sorted lost items ({size})"
+            tree.insert(size, 0)
+            tree.remove(0)
+            tree._check_valid()
+
+    tree = rbtree()
+    tree.load_sorted([(1, "a"), (1, "b"), (2, "c")])
+    assert tree[:] == [(1, "b"), (2, "c")], "load_sorted does not keep the last of equal keys"
+    try:
+        tree.load_sorted([(2, None), (1, None)])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("load_sorted accepts unsorted items")
+    assert tree[:] == [(1, "b"), (2, "c")], "Failed load_sorted modified the tree"
+
+
+def test_rbtree_range():
+    for tree_type in (rbtree, osrbtree):
+        tree = tree_type()
+        assert list(tree.range()) == [], "Range of an empty tree is not empty"
+        nums = [(i, i + 1) for i in range(0, 200, 2)]
+        shuffle(nums)
+        for key, val in nums:
+            tree.insert(key, val)
+        sorted_nums = sorted(nums)
+
+        assert list(tree.range()) == sorted_nums, "Open range does not yield all items"
+        assert list(tree.range(reverse=True)) == sorted_nums[::-1], "Open reverse range is not reversed"
+        for i in range(50):
+            lo, hi = randint(-5, 205), randint(-5, 205)
+            lo = None if lo < 0 else lo
+            hi = None if hi > 200 else hi
+            expected = [kv for kv in sorted_nums if (lo is None or lo <= kv[0]) and (hi is None or kv[0] < hi)]
+            assert list(tree.range(lo, hi)) == expected, f"Invalid range({lo}, {hi})"
+            assert list(tree.range(lo, hi, reverse=True)) == expected[::-1], f"Invalid reverse range({lo}, {hi})"
+
+    # Items are produced on demand
+    tree = rbtree([(i, i) for i in range(100)])
+    items = tree.range(10)
+    assert next(items) == (10, 10) and next(items) == (11, 11), "Range does not start at its lower bound"
+
+
 def run_rbtree_tests():
     tests = {
         ("Test left-left, right-right insertion", test_ll_rr_insertions),
@@ -830,6 +1130,10 @@ def run_rbtree_tests():
         ("Test Keys removed correctly          ", test_keys_correctly_removed),
         ("Test Remove edge cases               ", test_remove_edge_cases),
         ("Test Tree __len__                    ", test_len),
+        ("Test Deep Traversals                 ", test_deep_traversals),
+        ("Test Order Statistics                ", test_order_statistics),
+        ("Test Load Sorted                     ", test_load_sorted),
+        ("Test Range                           ", test_rbtree_range),
     }
 
     for test_name, test in tests:
@@ -0,0 +1,272 @@
+from bisect import bisect_left, bisect_right
+from random import randint, shuffle
+
+
+class sortedarray:
+    """Sorted key -> value index kept in blocks of plain lists.
+
+    Lookups bisect the block maxima and then the block, inserts and removes
+    shift at most `load * 2` items, and iteration walks lists with no node
+    objects, which makes it cheaper than `rbtree` for listing-heavy use.
+    It offers the same interface as `rbtree` for `Note.tree`.
+    """
+
+    def __init__(self, initializer=None, load=512):
+        self.load = load
+        self.count = 0
+        # Sorted blocks of keys with their values, and the last key of every block
+        self._keys = []
+        self._values = []
+        self._maxes = []
+
+        if initializer:
+            if type(initializer) == dict:
+                initializer = initializer.items()
+            for k in initializer:
+                if type(k) is tuple:
+                    self.insert(key=k[0], value=k[1])
+                else:
+                    self.insert(key=k)
+
+    def _locate(self, key):
+        """Block and position of `key`, or of where it would be inserted"""
+        i = bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            i -= 1
+        return i, bisect_left(self._keys[i], key)
+
+    def insert(self, key, value=None):
+        if not self._maxes:
+            self._keys.append([key])
+            self._values.append([value])
+            self._maxes.append(key)
+            self.count = 1
+            return
+
+        i, j = self._locate(key)
+        keys = self._keys[i]
+        if j < len(keys) and keys[j] == key:
+            self._values[i][j] = value
+            return
+        keys.insert(j, key)
+        self._values[i].insert(j, value)
+        self._maxes[i] = keys[-1]
+        self.count += 1
+
+        if len(keys) > self.load * 2:
+            # Split the block in halves
+            self._keys[i : i + 1] = [keys[: self.load], keys[self.load :]]
+            values = self._values[i]
+            self._values[i : i + 1] = [values[: self.load], values[self.load :]]
+            self._maxes[i : i + 1] = [keys[self.load - 1], keys[-1]]
+
+    def remove(self, key):
+        if not self._maxes:
+            return
+        i, j = self._locate(key)
+        keys = self._keys[i]
+        if j == len(keys) or keys[j] != key:
+            return
+        del keys[j]
+        del self._values[i][j]
+        self.count -= 1
+        if keys:
+            self._maxes[i] = keys[-1]
+        else:
+            del self._keys[i]
+            del self._values[i]
+            del self._maxes[i]
+
+    def load_sorted(self, items):
+        """Replace the contents with `(key, value)` items sorted by key, in O(n).
+
+        Of equal keys the last value is kept, like `insert`.
+        """
+        keys, values = [], []
+        for key, value in items:
+            if keys and not keys[-1] <= key:
+                raise ValueError("load_sorted needs items sorted by key: %s after %s" % (key, keys[-1]))
+            if keys and keys[-1] == key:
+                values[-1] = value
+            else:
+                keys.append(key)
+                values.append(value)
+
+        load = self.load
+        key_blocks = [keys[i : i + load] for i in range(0, len(keys), load)]
+        value_blocks = [values[i : i + load] for i in range(0, len(values), load)]
+        maxes = [block[-1] for block in key_blocks]
+        self._keys, self._values, self._maxes, self.count = key_blocks, value_blocks, maxes, len(keys)
+
+    def iter(self, value=True, reverse=False):
+        """Values (or `(key, value)` items) in key order, or in reverse order"""
+        if reverse:
+            for i in range(len(self._keys) - 1, -1, -1):
+                if value:
+                    yield from reversed(self._values[i])
+                else:
+                    yield from zip(reversed(self._keys[i]), reversed(self._values[i]))
+        else:
+            for i in range(len(self._keys)):
+                if value:
+                    yield from self._values[i]
+                else:
+                    yield from zip(self._keys[i], self._values[i])
+
+    def range(self, lo=None, hi=None, reverse=False):
+        """
+        Lazily yields the (key, value) items with lo <= key < hi, a None bound is left open.
+
+        Only the blocks overlapping the range are visited.
+        """
+        if lo is not None and hi is not None and not lo < hi:
+            return iter(())
+        return self._range_items(lo, hi, False, reverse)
+
+    def _range_items(self, lo, hi, hi_inclusive, reverse):
+        def end_of(keys):
+            if hi is None:
+                return len(keys)
+            return bisect_right(keys, hi) if hi_inclusive else bisect_left(keys, hi)
+
+        if reverse:
+            i = len(self._maxes) - 1 if hi is None else min(bisect_left(self._maxes, hi), len(self._maxes) - 1)
+            for i in range(i, -1, -1):
+                keys, values = self._keys[i], self._values[i]
+                start = 0 if lo is None else bisect_left(keys, lo)
+                end = end_of(keys)
+                yield from zip(reversed(keys[start:end]), reversed(values[start:end]))
+                if start > 0:
+                    return
+            return
+
+        i = 0 if lo is None else bisect_left(self._maxes, lo)
+        for i in range(i, len(self._keys)):
+            keys, values = self._keys[i], self._values[i]
+            start = 0 if lo is None else bisect_left(keys, lo)
+            end = end_of(keys)
+            yield from zip(keys[start:end], values[start:end])
+            if end < len(keys):
+                return
+
+    def find(self, key):
+        if not self._maxes:
+            return None
+        i, j = self._locate(key)
+        keys = self._keys[i]
+        if j < len(keys) and keys[j] == key:
+            return self._values[i][j]
+        return None
+
+    def __contains__(self, key):
+        if not self._maxes:
+            return False
+        i, j = self._locate(key)
+        keys = self._keys[i]
+        return j < len(keys) and keys[j] == key
+
+    def __getitem__(self, key):
+        if type(key) is slice:
+            # Both bounds are included, like `rbtree`
+            if key.start is not None and key.stop is not None and key.start > key.stop:
+                return []
+            return list(self._range_items(key.start, key.stop, True, False))
+        return self.find(key)
+
+    def __setitem__(self, key, value):
+        self.insert(key, value)
+
+    def __delitem__(self, key):
+        self.remove(key)
+
+    def __iter__(self):
+        return self.iter(value=False)
+
+    def __len__(self):
+        return self.count
+
+    def _check_valid(self):
+        keys = [key for block in self._keys for key in block]
+        if keys != sorted(set(keys)):
+            raise Exception("Invalid sortedarray: keys are not sorted and unique")
+        if any(not block for block in self._keys):
+            raise Exception("Invalid sortedarray: empty block")
+        if self._maxes != [block[-1] for block in self._keys]:
+            raise Exception("Invalid sortedarray: wrong block maxima")
+        if [len(block) for block in self._keys] != [len(block) for block in self._values]:
+            raise Exception("Invalid sortedarray: keys and values differ in length")
+        if len(keys) != self.count:
+            raise Exception("Invalid sortedarray: wrong count")
+
+
+def test_against_sorted_list():
+    array = sortedarray(load=4)
+    expected = {}
+    for i in range(2000):
+        key = randint(0, 300)
+        if randint(0, 2):
+            array.insert(key, -key)
+            expected[key] = -key
+        else:
+            array.remove(key)
+            expected.pop(key, None)
+        array._check_valid()
+
+    items = sorted(expected.items())
+    assert list(array.iter(value=False)) == items, "Invalid iteration"
+    assert list(array.iter(reverse=True)) == [v for k, v in reversed(items)], "Invalid reverse iteration"
+    for key in range(-1, 302):
+        assert (key in array) == (key in expected), f"Invalid membership of {key}"
+        assert array[key] == expected.get(key), f"Invalid value of {key}"
+    for i in range(50):
+        a, b = randint(-5, 305), randint(-5, 305)
+        assert array[a:b] == [(k, v) for k, v in items if a <= k <= b], f"Invalid slice [{a}:{b}]"
+    assert array[:] == items, "Slicing the whole array does not yield all items"
+
+
+def test_range():
+    array = sortedarray(load=4)
+    assert list(array.range()) == [] and list(array.range(reverse=True)) == [], "Range of an empty array"
+    items = [(i, i + 1) for i in range(0, 200, 2)]
+    for key, value in items:
+        array.insert(key, value)
+    for i in range(200):
+        lo, hi = randint(-5, 205), randint(-5, 205)
+        lo = None if lo < 0 else lo
+        hi = None if hi > 200 else hi
+        expected = [kv for kv in items if (lo is None or lo <= kv[0]) and (hi is None or kv[0] < hi)]
+        assert list(array.range(lo, hi)) == expected, f"Invalid range({lo}, {hi})"
+        assert list(array.range(lo, hi, reverse=True)) == expected[::-1], f"Invalid reverse range({lo}, {hi})"
+
+
+def test_load_sorted():
+    for size in [0, 1, 7, 8, 9, 100]:
+        array = sortedarray([(-1, None)], load=8)
+        items = [(i, i + 1) for i in range(size)]
+        shuffle(items)
+        array.load_sorted(sorted(items))
+        array._check_valid()
+        assert array[:] == sorted(items), f"load_sorted lost items ({size})"
+        array.insert(size, 0)
+        array.remove(0)
+        array._check_valid()
+
+
+def run_sortedarray_tests():
+    tests = {
+        ("Test against a sorted list", test_against_sorted_list),
+        ("Test Load Sorted          ", test_load_sorted),
+        ("Test Range                ", test_range),
+    }
+
+    for test_name, test in tests:
+        try:
+            print(f"Running [{test_name}]", end="")
+            test()
+            print(" Succeeded")
+        except AssertionError as e:
+            print(f" Failed => {e}")
+
+
+if __name__ == "__main__":
+    run_sortedarray_tests()